@@ -0,0 +1,399 @@
+# benchmarks for the slow parts of the project
+# everything runs offline and uses fixed seeds so runs can be compared
+#
+# python benchmark.py signatures --save baseline.json
+# python benchmark.py signatures --compare baseline.json
+# python benchmark.py mining --max-processes 8
+# python benchmark.py packing --sizes 10000 100000
+
+from utils import *
+from elliptic import EllipticCurveFF
+from signature import RSA, DSA, ECDSA, CompressedECDSA
+from miner import MinerNode, MiningStats
+from transaction import Transaction, transaction_size
+from blockchain import MAX_BLOCK_SIZE
+from mempool import Mempool, BlockTemplate
+
+import random
+from argparse import ArgumentParser
+from json import dump, load
+from time import perf_counter
+from multiprocessing import Process, Value, Array, Queue
+from queue import Empty
+
+# how much slower (as a fraction of ops/sec) a result can be before it counts as a regression
+DEFAULT_TOLERANCE = 0.2
+
+SIGNATURE_ALGORITHMS = {
+	"RSA": RSA,
+	"DSA": DSA,
+	"ECDSA": ECDSA,
+	"ECDSA-GLV": lambda: ECDSA(glv=True),
+	"CompressedECDSA": CompressedECDSA,
+	"CompressedECDSA-GLV": lambda: CompressedECDSA(glv=True),
+}
+
+
+"""
+Timing
+"""
+
+# time fn(*args) for each args in args_list
+# returns the latency of each call in seconds
+def time_calls(fn, args_list):
+	latencies = []
+	for args in args_list:
+		start = perf_counter()
+		fn(*args)
+		latencies.append(perf_counter() - start)
+	return latencies
+
+def percentile(sorted_values, pct):
+	if len(sorted_values) == 0:
+		return 0
+	i = min(len(sorted_values) - 1, int(pct/100*len(sorted_values)))
+	return sorted_values[i]
+
+def summarize(latencies):
+	latencies = sorted(latencies)
+	total = sum(latencies)
+	return {
+		"count": len(latencies),
+		"ops_per_sec": len(latencies)/total if total > 0 else 0,
+		"mean_ms": 1000*total/len(latencies),
+		"p50_ms": 1000*percentile(latencies, 50),
+		"p90_ms": 1000*percentile(latencies, 90),
+		"p99_ms": 1000*percentile(latencies, 99),
+	}
+
+
+"""
+Signature algorithms
+"""
+
+# the G table and public key caches are shared by every instance, so they are cleared first
+# otherwise results would depend on which algorithms ran before
+def reset_signature_caches():
+	ECDSA._G_table = None
+	CompressedECDSA._pub_cache.clear()
+	CompressedECDSA._pub_table_cache.clear()
+
+def bench_signature(make_algorithm, iterations, keygen_iterations, seed, num_keys=4):
+	random.seed(seed)
+	reset_signature_caches()
+
+	# setup includes building the G table so it isn't counted in the first keygen
+	start = perf_counter()
+	alg = make_algorithm()
+	if isinstance(alg, ECDSA):
+		alg._mult_G(1)
+	setup = perf_counter() - start
+
+	keygen = time_calls(alg.keygen, [()]*keygen_iterations)
+
+	# a few keys reused, like a handful of addresses sending most transactions
+	keys = [alg.keygen() for i in range(num_keys)]
+	hashes = [hash_int(i) for i in range(iterations)]
+	sign_args = [(H, keys[i%num_keys][1]) for i, H in enumerate(hashes)]
+
+	sigs = []
+	sign = time_calls(lambda H, priv: sigs.append(alg.sign(H, priv)), sign_args)
+
+	verify_args = [(H, sigs[i], keys[i%num_keys][0]) for i, H in enumerate(hashes)]
+	verify = time_calls(alg.verify, verify_args)
+
+	if not all(alg.verify(*args) for args in verify_args[:num_keys]):
+		raise Exception("Signature did not verify")
+
+	return {
+		"setup_ms": 1000*setup,
+		"keygen": summarize(keygen),
+		"sign": summarize(sign),
+		"verify": summarize(verify),
+	}
+
+def bench_elliptic(iterations, seed):
+	random.seed(seed)
+	reset_signature_caches()
+	e = ECDSA()
+	curve = EllipticCurveFF(e.curve.p, e.curve.A, e.curve.B)
+
+	points = [e.keygen()[0] for i in range(iterations)]
+	nums = [randint(0, e.n-1) for i in range(iterations)]
+
+	return {
+		"mult": summarize(time_calls(curve.mult, list(zip(points, nums)))),
+		"multi_mult": summarize(time_calls(lambda P, a, b: curve.multi_mult([e.G, P], [a, b]), list(zip(points, nums, reversed(nums))))),
+	}
+
+def bench_signatures(iterations=50, keygen_iterations=3, seed=0, algorithms=None):
+	if algorithms is None:
+		algorithms = list(SIGNATURE_ALGORITHMS)
+
+	results = {}
+	for name in algorithms:
+		results[name] = bench_signature(SIGNATURE_ALGORITHMS[name], iterations, keygen_iterations, seed)
+	results["EllipticCurveFF"] = bench_elliptic(iterations, seed)
+	return results
+
+
+"""
+Mining
+"""
+
+# runs the mining kernel in [num_processes] processes for [duration] seconds
+# on a fixed data hash at a fixed difficulty
+def bench_mining_processes(num_processes, duration, difficulty, seed):
+	data_hash = Array("c", 44)
+	target = Array("c", 32)
+	job_id = Value("Q", 0, lock=False)
+	mining = Value("b", True)
+	queue = Queue()
+	stats = MiningStats(num_processes)
+
+	data_hash.value = hash_base64(seed).encode()
+	target.raw = target_to_bytes(difficulty_to_target(difficulty))
+	job_id.value = 1
+
+	processes = [
+		Process(target=MinerNode.mining_process, args=(data_hash, target, job_id, mining, queue, "", i, stats))
+		for i in range(num_processes)
+	]
+
+	start = perf_counter()
+	for p in processes:
+		p.start()
+
+	# time between solutions (the first one is timed from the start)
+	solution_times = []
+	last = start
+	while perf_counter() - start < duration:
+		try:
+			queue.get(timeout=max(0, duration - (perf_counter() - start)))
+		except Empty:
+			continue
+		now = perf_counter()
+		solution_times.append(now - last)
+		last = now
+
+	mining.value = False
+	for p in processes:
+		p.join()
+	elapsed = perf_counter() - start
+
+	# solutions that came in while the processes were stopping
+	while True:
+		try:
+			queue.get_nowait()
+		except Empty:
+			break
+
+	res = summarize(solution_times) if len(solution_times) > 0 else summarize([elapsed])
+	res["count"] = len(solution_times)
+	res["ops_per_sec"] = sum(stats.hashes)/elapsed
+	return res
+
+# hashes/sec and time to solution for 1 to [max_processes] processes
+# efficiency is the hashrate compared to the 1 process hashrate times the number of processes
+def bench_mining(max_processes=4, duration=5, difficulty=10**6, seed=0):
+	results = {}
+	single = None
+	for n in range(1, max_processes+1):
+		res = bench_mining_processes(n, duration, difficulty, seed)
+		if single is None:
+			single = res["ops_per_sec"]
+		res["efficiency"] = res["ops_per_sec"]/(n*single) if single > 0 else 0
+		results["{} processes".format(n)] = res
+	return {"mining": results}
+
+def print_mining_results(results):
+	print("{:<32}{:>12}{:>12}{:>12}{:>12}{:>12}".format("", "hashes/sec", "efficiency", "solutions", "p50 ms", "p90 ms"))
+	for name, s in results["mining"].items():
+		print("{:<32}{:>12.0f}{:>12.1%}{:>12}{:>12.1f}{:>12.1f}".format(name, s["ops_per_sec"], s["efficiency"], s["count"], s["p50_ms"], s["p90_ms"]))
+
+
+"""
+Block packing
+"""
+
+# [num] random transactions and the balances of their senders
+# some senders start with nothing and can only spend what other transactions send them
+def synthetic_mempool(num, seed):
+	random.seed(seed)
+
+	senders = ["sender{}".format(i) for i in range(max(num//10, 1))]
+	balances = {}
+	for addr in senders:
+		if random.random() < 0.8:
+			balances[addr] = randint(100, 10000)
+
+	ts = []
+	for i in range(num):
+		from_addr = random.choice(senders)
+		to_addr = random.choice(senders) if random.random() < 0.3 else "receiver{}".format(i)
+		t = Transaction(from_addr, to_addr, randint(1, 500), int(random.expovariate(1/20)), "".join(random.choice("0123456789abcdef") for j in range(randint(8, 64))))
+		t.approve("sig" + str(i), "pub" + str(i))
+		ts.append(t)
+
+	return ts, balances
+
+# the old way of building a block: highest miner fee first,
+# only spending money senders had before the block, up to [max_transactions] or [max_size]
+def greedy_block(ts, balances, max_size=MAX_BLOCK_SIZE, max_transactions=None):
+	res = []
+	size = 0
+	spending = {}
+	for t in sorted(ts, key=lambda t: -t.miner_fee):
+		cost = t.amount + t.miner_fee
+		t_size = transaction_size(t)
+		if spending.get(t.from_addr, 0) + cost > balances.get(t.from_addr, 0) or size + t_size > max_size:
+			continue
+
+		spending[t.from_addr] = spending.get(t.from_addr, 0) + cost
+		size += t_size
+		res.append(t)
+		if max_transactions is not None and len(res) >= max_transactions:
+			break
+	return res
+
+def template_block(ts, balances, max_size=MAX_BLOCK_SIZE):
+	mempool = Mempool(max_entries=len(ts), max_bytes=float("inf"))
+	for t in ts:
+		mempool.add(t)
+
+	start = perf_counter()
+	template = BlockTemplate(mempool, max_size)
+	template.set_balances("tip", {addr: balances.get(addr) for addr in mempool.by_sender})
+	res = template.get()
+	return res, perf_counter() - start
+
+def packing_summary(block, build_time):
+	return {
+		"ops_per_sec": 1/build_time if build_time > 0 else 0,
+		"build_ms": 1000*build_time,
+		"fees": sum(t.miner_fee for t in block),
+		"transactions": len(block),
+		"size": sum(transaction_size(t) for t in block),
+	}
+
+# fees collected and time to build a block from mempools of each size
+def bench_packing(sizes=[10000, 30000, 100000], seed=0):
+	results = {}
+	for num in sizes:
+		ts, balances = synthetic_mempool(num, seed)
+		res = {}
+
+		start = perf_counter()
+		block = greedy_block(ts, balances, max_transactions=20)
+		res["greedy (20 transactions)"] = packing_summary(block, perf_counter() - start)
+
+		start = perf_counter()
+		block = greedy_block(ts, balances)
+		res["greedy"] = packing_summary(block, perf_counter() - start)
+
+		res["template"] = packing_summary(*template_block(ts, balances))
+
+		results["packing {}".format(num)] = res
+	return results
+
+def print_packing_results(results):
+	print("{:<40}{:>12}{:>12}{:>14}{:>12}".format("", "build ms", "fees", "transactions", "bytes"))
+	for name, s in _flatten(results).items():
+		print("{:<40}{:>12.1f}{:>12}{:>14}{:>12}".format(name, s["build_ms"], s["fees"], s["transactions"], s["size"]))
+
+
+"""
+Reporting
+"""
+
+# flattens results into {"RSA sign": {...}, ...} for every summary
+def _flatten(results):
+	res = {}
+	for group, ops in results.items():
+		for op, summary in ops.items():
+			if isinstance(summary, dict):
+				res[group + " " + op] = summary
+	return res
+
+def print_results(results):
+	print("{:<32}{:>12}{:>12}{:>12}{:>12}".format("", "ops/sec", "p50 ms", "p90 ms", "p99 ms"))
+	for name, s in _flatten(results).items():
+		print("{:<32}{:>12.1f}{:>12.3f}{:>12.3f}{:>12.3f}".format(name, s["ops_per_sec"], s["p50_ms"], s["p90_ms"], s["p99_ms"]))
+
+# returns a list of (name, baseline ops/sec, current ops/sec) that got slower than the tolerance allows
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+	regressions = []
+	current = _flatten(results)
+	for name, s in _flatten(baseline).items():
+		if name not in current:
+			continue
+		if current[name]["ops_per_sec"] < (1 - tolerance)*s["ops_per_sec"]:
+			regressions.append((name, s["ops_per_sec"], current[name]["ops_per_sec"]))
+	return regressions
+
+def print_comparison(results, baseline, tolerance=DEFAULT_TOLERANCE):
+	current = _flatten(results)
+	print()
+	print("{:<32}{:>12}{:>12}{:>10}".format("", "baseline", "current", "change"))
+	for name, s in _flatten(baseline).items():
+		if name in current and s["ops_per_sec"] > 0:
+			change = current[name]["ops_per_sec"]/s["ops_per_sec"] - 1
+			print("{:<32}{:>12.1f}{:>12.1f}{:>+10.1%}".format(name, s["ops_per_sec"], current[name]["ops_per_sec"], change))
+
+	regressions = compare(results, baseline, tolerance)
+	for name, before, after in regressions:
+		print("REGRESSION:", name, "went from {:.1f} to {:.1f} ops/sec".format(before, after))
+	return regressions
+
+
+def main(argv=None):
+	parser = ArgumentParser(description="Benchmarks for the blockchain")
+	subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+	sig_parser = subparsers.add_parser("signatures", help="keygen/sign/verify for each signature algorithm")
+	sig_parser.add_argument("--iterations", type=int, default=50)
+	sig_parser.add_argument("--keygen-iterations", type=int, default=3)
+	sig_parser.add_argument("--seed", type=int, default=0)
+	sig_parser.add_argument("--algorithms", nargs="+", choices=list(SIGNATURE_ALGORITHMS))
+
+	mining_parser = subparsers.add_parser("mining", help="hashes/sec and time to solution of the mining kernel")
+	mining_parser.add_argument("--max-processes", type=int, default=4)
+	mining_parser.add_argument("--duration", type=float, default=5, help="seconds to mine for each number of processes")
+	mining_parser.add_argument("--difficulty", type=int, default=10**6, help="expected hashes per solution")
+	mining_parser.add_argument("--seed", type=int, default=0)
+
+	packing_parser = subparsers.add_parser("packing", help="fees and build time of block templates against greedy packing")
+	packing_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 30000, 100000], help="numbers of transactions in the mempool")
+	packing_parser.add_argument("--seed", type=int, default=0)
+
+	for p in [sig_parser, mining_parser, packing_parser]:
+		p.add_argument("--save", help="write the results to this JSON file")
+		p.add_argument("--compare", help="compare against results saved with --save")
+		p.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+
+	args = parser.parse_args(argv)
+
+	if args.benchmark == "signatures":
+		results = bench_signatures(args.iterations, args.keygen_iterations, args.seed, args.algorithms)
+		print_results(results)
+	elif args.benchmark == "mining":
+		results = bench_mining(args.max_processes, args.duration, args.difficulty, args.seed)
+		print_mining_results(results)
+	elif args.benchmark == "packing":
+		results = bench_packing(args.sizes, args.seed)
+		print_packing_results(results)
+
+	if args.save is not None:
+		with open(args.save, "w") as f:
+			dump(results, f, indent=2)
+
+	if args.compare is not None:
+		with open(args.compare) as f:
+			baseline = load(f)
+		if len(print_comparison(results, baseline, args.tolerance)) > 0:
+			return 1
+
+	return 0
+
+if __name__=="__main__":
+	exit(main())
@@ -3,32 +3,60 @@
 # these can be turned into actions which allows the graph structure of the blockchain to work efficiently
 
 from utils import *
-from transaction import Transaction, Ledger
+from transaction import Transaction, Ledger, transaction_size
+
+from time import time
+
+# difficulty is adjusted every RETARGET_INTERVAL blocks
+# so that blocks take about TARGET_BLOCK_TIME seconds
+TARGET_BLOCK_TIME = 60
+RETARGET_INTERVAL = 20
+
+# the target can change by at most this factor in one adjustment
+MAX_RETARGET_FACTOR = 4
+
+# a block's timestamp must be after the median of the previous MEDIAN_TIME_SPAN blocks
+# and at most MAX_FUTURE_BLOCK_TIME seconds ahead of our clock
+MEDIAN_TIME_SPAN = 11
+MAX_FUTURE_BLOCK_TIME = 2*60*60
+
+# total size in bytes of the transactions in a block
+MAX_BLOCK_SIZE = 100000
+
+# hash of everything in a block except the nonce
+# this is all a miner needs when searching for a nonce
+def block_data_hash(prev_block_hash, transactions, miner, timestamp):
+	# TODO: maybe implement merkle root later
+	transactions_hash = hash_base64(" ".join(t.hash for t in transactions))
+	return hash_base64(prev_block_hash + transactions_hash + miner + " " + str(timestamp))
 
 # block of transactions
+# timestamp is in seconds
 class Block:
-	def __init__(self, transactions, miner, prev_block_hash, nonce):
+	def __init__(self, transactions, miner, prev_block_hash, nonce, timestamp):
 		self.transactions = transactions
 		self.miner = miner
 		self.prev_block_hash = prev_block_hash
 		self.nonce = nonce
+		self.timestamp = int(timestamp)
+
+		self.digest = self.calc_digest()
+		self.hash = digest_to_base64(self.digest)
 
-		self.hash = self.calc_hash()
+	def calc_digest(self):
+		return hash_digest(block_data_hash(self.prev_block_hash, self.transactions, self.miner, self.timestamp) + self.nonce)
 
 	def calc_hash(self):
-		# TODO: maybe implement merkle root later
-		transactions_hash = hash_base64(" ".join(t.hash for t in self.transactions))
-		data_hash = hash_base64(self.prev_block_hash + transactions_hash + self.miner)
-		return hash_base64(data_hash + self.nonce)
+		return digest_to_base64(self.calc_digest())
 
 	def convert_to_str(self):
-		res = "\n".join([self.prev_block_hash, self.miner, self.nonce] + [t.convert_to_str() for t in self.transactions])
+		res = "\n".join([self.prev_block_hash, self.miner, str(self.timestamp), self.nonce] + [t.convert_to_str() for t in self.transactions])
 		return res
 
 	def convert_from_str(s):
-		prev_block_hash, miner, nonce, *transactions = s.split("\n")
+		prev_block_hash, miner, timestamp, nonce, *transactions = s.split("\n")
 		transactions = [Transaction.convert_from_str(t) for t in transactions]
-		return Block(transactions, miner, prev_block_hash, nonce)
+		return Block(transactions, miner, prev_block_hash, nonce, int(timestamp))
 		
 
 # block parsed for use in the blockchain graph
@@ -42,6 +70,13 @@ class BlockchainNode:
 		self.next_nodes = []
 		self.height = self.prev_node.height + 1
 
+		self.timestamp = block.timestamp
+		self.target = self.prev_node.next_target()
+
+		# expected number of hashes it took to make this block and the ones before it
+		# the chain with the most work wins, not the longest one
+		self.work = self.prev_node.work + MAX_TARGET//self.target
+
 		self.net_ledger = {}
 		self.transaction_hashes = set()
 
@@ -62,13 +97,43 @@ class BlockchainNode:
 	def create_action(self, undo=True):
 		return LedgerStateAction(self, undo)
 
+	# target that the block after this one has to meet
+	def next_target(self):
+		if (self.height + 1)%RETARGET_INTERVAL != 0 or self.height < RETARGET_INTERVAL:
+			return self.target
+
+		# time taken by the last RETARGET_INTERVAL blocks
+		# measured from the last block of the window before so no time between windows is left out
+		first = self
+		for i in range(RETARGET_INTERVAL):
+			first = first.prev_node
+		elapsed = self.timestamp - first.timestamp
+		expected = TARGET_BLOCK_TIME*RETARGET_INTERVAL
+
+		elapsed = min(max(elapsed, expected//MAX_RETARGET_FACTOR), expected*MAX_RETARGET_FACTOR)
+		return min(MAX_TARGET, self.target*elapsed//expected)
+
+	# median timestamp of this block and the ones before it
+	def median_time_past(self):
+		times = []
+		node = self
+		while node is not None and len(times) < MEDIAN_TIME_SPAN:
+			times.append(node.timestamp)
+			node = node.prev_node
+		return sorted(times)[len(times)//2]
+
 # starting node for the blockchain
 class Block0(BlockchainNode):
 	def __init__(self):
 		self.height = 0
 		self.hash = "0"
+		self.prev_node = None
 		self.next_nodes = []
 
+		self.timestamp = 0
+		self.target = INITIAL_TARGET
+		self.work = 0
+
 	def create_action(self, undo=True):
 		raise NotImplementedError("Can't create action for the first node")
 
@@ -78,6 +143,8 @@ class LedgerStateAction:
 	def __init__(self, node, undo):
 		self.node = node
 		self.undo = undo
+
+	# returns True if the block was undone
 	def execute(self, ledger, reverse=False):
 		undo = self.undo if not reverse else not self.undo
 		if not undo:
@@ -93,20 +160,30 @@ class LedgerStateAction:
 				ledger.money[addr] -= self.node.net_ledger[addr]
 			ledger.current_node = self.node.prev_node
 
+		return undo
+
 # tracks the current state of the ledger
 # blocks can be added or undone to the state
 class LedgerState(Ledger):
 	def __init__(self, current_node):
 		super().__init__()
 		self.current_node = current_node
-		self.max_height = current_node.height
+		self.max_work = current_node.work
 
+	# returns (disconnected, connected), the nodes that were undone and redone in order
 	def update(self, actions, reverse=False):
 		if reverse:
 			actions = reversed(actions)
 
+		disconnected = []
+		connected = []
 		for a in actions:
-			a.execute(self, reverse)
+			if a.execute(self, reverse):
+				disconnected.append(a.node)
+			else:
+				connected.append(a.node)
+
+		return disconnected, connected
 
 class AddBlockException(Exception):
 	pass
@@ -120,6 +197,9 @@ class BlockchainManager:
 		self.past_blocks = set([self.starting_block.hash]) # hashes of past blocks
 		self.ledger = LedgerState(self.starting_block)
 
+		# signature.VerificationPool for checking the signatures in a block in parallel
+		self.verification_pool = None
+
 	def _find_node(self, target_hash, current_path=None, visited=None):
 		# assumes the ledger's current node doesn't have any next nodes
 		current_node = self.ledger.current_node
@@ -169,21 +249,33 @@ class BlockchainManager:
 			current_node = next_node
 
 	def add_block(self, block):
-		# TODO add max block length??
-
-		if not proof_of_work_verify(block.hash):
-			raise AddBlockException("Proof of work failed")
-
 		if block.hash in self.past_blocks:
 			raise AddBlockException("Block already exists")
 
 		if block.prev_block_hash not in self.past_blocks:
 			raise AddBlockException("Previous block does not exist")
 
+		if sum(transaction_size(t) for t in block.transactions) > MAX_BLOCK_SIZE:
+			raise AddBlockException("Block is too large")
+
 		prev_node, actions = self._find_node(block.prev_block_hash)
-		self.ledger.update(actions)
 
-		if not self.ledger.is_valid_multiple(block.transactions):
+		if not proof_of_work_check(block.digest, target_to_bytes(prev_node.next_target())):
+			raise AddBlockException("Proof of work failed")
+
+		if block.timestamp <= prev_node.median_time_past() or block.timestamp > time() + MAX_FUTURE_BLOCK_TIME:
+			raise AddBlockException("Invalid timestamp")
+
+		disconnected, connected = self.ledger.update(actions)
+
+		# go back to the current block if the transactions are invalid or checking them fails
+		try:
+			valid = self.ledger.is_valid_multiple(block.transactions, pool=self.verification_pool)
+		except:
+			valid = False
+
+		if not valid:
+			self.ledger.update(actions, reverse=True)
 			raise AddBlockException("Invalid or repeat transactions in block")
 		
 		new_node = BlockchainNode(block, prev_node)
@@ -191,12 +283,22 @@ class BlockchainManager:
 
 		self.past_blocks.add(new_node.hash)
 
-		# only reverse if the new block is strictly higher than the old block
-		if self.ledger.max_height >= new_node.height:
+		# only switch if the new block has strictly more work than the old block
+		if self.ledger.max_work >= new_node.work:
 			self.ledger.update(actions, reverse=True)
 		else:
-			self.ledger.max_height = new_node.height
+			self.ledger.max_work = new_node.work
 			self.ledger.update([LedgerStateAction(new_node, False)])
+			self.on_chain_update(disconnected, connected + [new_node])
+
+	# called whenever the current block changes
+	# [disconnected] are the nodes undone (newest first) and [connected] are the nodes added (oldest first)
+	def on_chain_update(self, disconnected, connected):
+		pass
 
 	def get_prev_block_hash(self):
-		return self.ledger.current_node.hash
\ No newline at end of file
+		return self.ledger.current_node.hash
+
+	# target and earliest allowed timestamp for a block on top of the current one
+	def get_next_block_rules(self):
+		return (self.ledger.current_node.next_target(), self.ledger.current_node.median_time_past() + 1)
\ No newline at end of file
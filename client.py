@@ -30,7 +30,7 @@ class Wallet:
 	def create_transaction(self, account_name, to_addr, amount, miner_fee):
 		addr, pub, priv = self.accounts[account_name]
 		t = Transaction(addr, to_addr, amount, miner_fee, hash_base64(randint(1,2**20)))
-		H = hash_int(t)
+		H = digest_to_int(t.digest)
 		t.approve(self.sig_algorithm.sign(H, priv), pub)
 		return t
 
@@ -52,6 +52,22 @@ class Wallet:
 		for i in self.known_miners:
 			Thread(target=self.send_transaction, args=(i, t)).start()
 
+	# send many transactions to a node in one request
+	# returns a result for each transaction ("ACCEPTED" if the node took it) or None if the node couldn't be reached
+	def send_transactions(self, web_addr, ts):
+		try:
+			with urlopen(Request(web_addr + "/transaction/batch", data=urlencode({"data":"\n".join(ts)}).encode())) as res:
+				return res.read().decode().split("\n")
+		except:
+			if web_addr in self.known_miners:
+				self.known_miners.remove(web_addr)
+
+	# creates transactions for each (to_addr, amount, miner_fee) in [payments] and sends them to all nodes
+	def transact_batch(self, account_name, payments):
+		ts = [self.create_transaction(account_name, to_addr, amount, miner_fee).convert_to_str() for to_addr, amount, miner_fee in payments]
+		for i in self.known_miners:
+			Thread(target=self.send_transactions, args=(i, ts)).start()
+
 	# finds new miners from its current miners
 	def add_miners(self, source):
 		try:
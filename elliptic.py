@@ -2,18 +2,42 @@
 
 from utils import *
 
-# pretend this is immutable
-# keep values between 0 and p-1
+# immutable point with coordinates between 0 and p-1
+# the point at infinity is O, the only point with x and y set to None
+# points can be compared with == and used as dictionary keys
 class Point:
+	__slots__ = ("x", "y")
+
 	def __init__(self, x, y):
-		self.x = x
-		self.y = y
+		object.__setattr__(self, "x", x)
+		object.__setattr__(self, "y", y)
+
+	def __setattr__(self, name, value):
+		raise AttributeError("Point is immutable")
+
+	def __delattr__(self, name):
+		raise AttributeError("Point is immutable")
+
+	def __eq__(self, other):
+		if not isinstance(other, Point):
+			return NotImplemented
+		return self.x == other.x and self.y == other.y
+
+	def __hash__(self):
+		return hash((self.x, self.y))
+
+	# pickle O as a reference so it stays the same object
+	def __reduce__(self):
+		if self is O:
+			return "O"
+		return (Point, (self.x, self.y))
+
 	def __repr__(self):
 		if self is O:
 			return "O"
 		return str((self.x, self.y))
 
-O = Point(-1, -1)
+O = Point(None, None)
 
 # elliptic curves over the integers mod p
 # make sure 4A^3 + 27B^2 != 0
@@ -24,7 +48,7 @@ class EllipticCurveFF:
 		self.B = B
 
 	def equals(self, p1, p2):
-		return p1.x==p2.x and p1.y==p2.y
+		return p1 == p2
 
 	def contains_point(self, point):
 		if point is O:
@@ -49,17 +73,192 @@ class EllipticCurveFF:
 		x3 = (pow(l,2,self.p) - point1.x - point2.x)%self.p
 		return Point(x3, (l*(point1.x-x3)%self.p - point1.y)%self.p)
 
+	# points in jacobian coordinates are tuples (X, Y, Z)
+	# they represent the affine point (X/Z^2, Y/Z^3)
+	# Z == 0 is the point at infinity
+	# this avoids doing a modular inverse for every add and double
+	def _to_jacobian(self, point):
+		if point is O:
+			return (1, 1, 0)
+		return (point.x, point.y, 1)
+
+	def _from_jacobian(self, jpoint):
+		X, Y, Z = jpoint
+		if Z == 0:
+			return O
+		z_inv = mod_inv(Z, self.p)
+		z_inv2 = z_inv*z_inv%self.p
+		return Point(X*z_inv2%self.p, Y*z_inv2*z_inv%self.p)
+
+	# convert many jacobian points to affine points with only one inverse
+	def normalize(self, jpoints):
+		finite = [jpoint for jpoint in jpoints if jpoint[2] != 0]
+		z_invs = iter(batch_mod_inv([jpoint[2] for jpoint in finite], self.p))
+
+		res = []
+		for X, Y, Z in jpoints:
+			if Z == 0:
+				res.append(O)
+				continue
+			z_inv = next(z_invs)
+			z_inv2 = z_inv*z_inv%self.p
+			res.append(Point(X*z_inv2%self.p, Y*z_inv2*z_inv%self.p))
+		return res
+
+	def _jacobian_double(self, jpoint):
+		X, Y, Z = jpoint
+		p = self.p
+		if Z == 0 or Y == 0:
+			return (1, 1, 0)
+
+		YY = Y*Y%p
+		S = 4*X*YY%p
+		M = 3*X*X
+		if self.A != 0:
+			ZZ = Z*Z%p
+			M += self.A*ZZ*ZZ
+		M %= p
+
+		X3 = (M*M - 2*S)%p
+		Y3 = (M*(S - X3) - 8*YY*YY)%p
+		Z3 = 2*Y*Z%p
+		return (X3, Y3, Z3)
+
+	# add a jacobian point and an affine point
+	def _jacobian_add_affine(self, jpoint, point):
+		if point is O:
+			return jpoint
+		X1, Y1, Z1 = jpoint
+		if Z1 == 0:
+			return (point.x, point.y, 1)
+		p = self.p
+
+		Z1Z1 = Z1*Z1%p
+		U2 = point.x*Z1Z1%p
+		S2 = point.y*Z1*Z1Z1%p
+		H = (U2 - X1)%p
+		r = (S2 - Y1)%p
+
+		if H == 0:
+			if r == 0:
+				return self._jacobian_double(jpoint)
+			return (1, 1, 0)
+
+		HH = H*H%p
+		HHH = H*HH%p
+		V = X1*HH%p
+
+		X3 = (r*r - HHH - 2*V)%p
+		Y3 = (r*(V - X3) - Y1*HHH)%p
+		Z3 = Z1*H%p
+		return (X3, Y3, Z3)
+
 	# find point + point + ... + point (n times)
+	# double and add in jacobian coordinates with only one inverse at the end
 	def mult(self, point, num):
-		res = O
-		to_add = point
-		while num > 0:
-			add = num & 1
-			if add:
-				res = self.add(res, to_add)
-			num >>= 1
-			to_add = self.add(to_add, to_add)
-		return res
+		if point is O or num <= 0:
+			return O
+
+		res = (1, 1, 0)
+		for bit in bin(num)[2:]:
+			res = self._jacobian_double(res)
+			if bit == "1":
+				res = self._jacobian_add_affine(res, point)
+		return self._from_jacobian(res)
+
+	# [O, point, 2*point, ..., (2^window - 1)*point]
+	# jacobian=True keeps the points in jacobian coordinates so no inverses are needed
+	def window_table(self, point, window=4, jacobian=False):
+		row = [(1, 1, 0)]
+		for j in range(1, 1 << window):
+			row.append(self._jacobian_add_affine(row[-1], point))
+
+		if jacobian:
+			return row
+		return self.normalize(row)
+
+	# negate an affine or jacobian point
+	def _negate_entry(self, entry):
+		if entry is O:
+			return O
+		if isinstance(entry, tuple):
+			return (entry[0], -entry[1]%self.p, entry[2])
+		return Point(entry.x, -entry.y%self.p)
+
+	# find points[0]*nums[0] + points[1]*nums[1] + ...
+	# uses Strauss's method: all the points share one set of doublings
+	# tables[i] can be a window_table for points[i] that was already computed
+	def multi_mult(self, points, nums, tables=None, window=4):
+		if tables is None:
+			tables = [None]*len(points)
+
+		rows = []
+		scalars = []
+		for point, num, table in zip(points, nums, tables):
+			if point is O or num == 0:
+				continue
+
+			if table is None:
+				table = self.window_table(point, window, jacobian=True)
+
+			rows.append(table)
+			scalars.append(num)
+
+		if len(scalars) == 0:
+			return O
+
+		# make every table affine with one inverse so the cheaper mixed add can be used
+		jacobian_rows = [i for i in range(len(rows)) if isinstance(rows[i][1], tuple)]
+		if len(jacobian_rows) > 0:
+			flat = self.normalize([entry for i in jacobian_rows for entry in rows[i]])
+			size = 1 << window
+			for k, i in enumerate(jacobian_rows):
+				rows[i] = flat[k*size:(k+1)*size]
+
+		# point * -num = (-point) * num
+		for i in range(len(rows)):
+			if scalars[i] < 0:
+				rows[i] = [self._negate_entry(entry) for entry in rows[i]]
+				scalars[i] = -scalars[i]
+
+		mask = (1 << window) - 1
+		shift = (max(num.bit_length() for num in scalars) + window - 1)//window*window
+		res = (1, 1, 0)
+		while shift > 0:
+			shift -= window
+			for i in range(window):
+				res = self._jacobian_double(res)
+			for row, num in zip(rows, scalars):
+				j = (num >> shift) & mask
+				if j:
+					res = self._jacobian_add_affine(res, row[j])
+		return self._from_jacobian(res)
+
+	# precompute multiples of a point that will be multiplied many times
+	# windows[i][j] = j * 2^(window*i) * point
+	def precompute(self, point, window=4, bits=None):
+		if bits is None:
+			bits = self.p.bit_length()
+		return FixedBaseTable(self, point, window, bits)
+
+	# find point * num using a table from precompute
+	# no doublings are needed, just one add per window
+	def mult_fixed(self, table, num):
+		if num <= 0:
+			return O
+		if num.bit_length() > table.window*len(table.windows):
+			return self.mult(table.point, num)
+
+		mask = (1 << table.window) - 1
+		res = (1, 1, 0)
+		for row in table.windows:
+			j = num & mask
+			if j:
+				res = self._jacobian_add_affine(res, row[j])
+			num >>= table.window
+			if num == 0:
+				break
+		return self._from_jacobian(res)
 
 	def find_point(self, x):
 		a = (pow(x, 3, self.p) + self.A*x%self.p + self.B)%self.p
@@ -83,5 +282,83 @@ class EllipticCurveFF:
 		parity = compressed_value & 1
 		point = self.find_point(compressed_value >> 1)
 		if not point.y%2 == parity:
-			point.y = -point.y%self.p
-		return point
\ No newline at end of file
+			point = Point(point.x, -point.y%self.p)
+		return point
+
+# table of multiples of a fixed point
+# see EllipticCurveFF.precompute
+class FixedBaseTable:
+	def __init__(self, curve, point, window, bits):
+		self.point = point
+		self.window = window
+
+		# build every row in jacobian coordinates and convert them all at once
+		jacobian_windows = []
+		base = point
+		for i in range((bits + window - 1)//window):
+			row = curve.window_table(base, window, jacobian=True)
+			jacobian_windows.append(row)
+
+			# next base is 2^window * base
+			base = curve._from_jacobian(curve._jacobian_double(row[1 << (window-1)]))
+
+		size = 1 << window
+		flat = curve.normalize([entry for row in jacobian_windows for entry in row])
+		self.windows = [flat[i:i+size] for i in range(0, len(flat), size)]
+
+
+# elliptic curve with an efficiently computable endomorphism
+# phi(x, y) = (beta*x, y) = lam*(x, y) for every point
+# scalars get split into two halves so multiplying only needs half the doublings (GLV method)
+# only valid when every point has prime order n (like secp256k1)
+class GLVCurveFF(EllipticCurveFF):
+	# (a1, b1) and (a2, b2) are short vectors with a + b*lam = 0 mod n
+	def __init__(self, p, A, B, n, beta, lam, basis):
+		super().__init__(p, A, B)
+		self.n = n
+		self.beta = beta
+		self.lam = lam
+		(self.a1, self.b1), (self.a2, self.b2) = basis
+
+	def endomorphism(self, entry):
+		if entry is O:
+			return O
+		if isinstance(entry, tuple):
+			return (self.beta*entry[0]%self.p, entry[1], entry[2])
+		return Point(self.beta*entry.x%self.p, entry.y)
+
+	# returns (k1, k2) with k = k1 + k2*lam mod n
+	# both are around sqrt(n) in size, but might be negative
+	def decompose(self, k):
+		k %= self.n
+		half = self.n >> 1
+		c1 = (self.b2*k + half)//self.n
+		c2 = (-self.b1*k + half)//self.n
+		k1 = k - c1*self.a1 - c2*self.a2
+		k2 = -c1*self.b1 - c2*self.b2
+		return (k1, k2)
+
+	def mult(self, point, num):
+		if point is O or num <= 0:
+			return O
+		return self.multi_mult([point], [num])
+
+	def multi_mult(self, points, nums, tables=None, window=4):
+		if tables is None:
+			tables = [None]*len(points)
+
+		split_points = []
+		split_nums = []
+		split_tables = []
+		for point, num, table in zip(points, nums, tables):
+			if point is O or num == 0:
+				continue
+			if table is None:
+				table = self.window_table(point, window, jacobian=True)
+
+			k1, k2 = self.decompose(num)
+			split_points += [point, self.endomorphism(point)]
+			split_nums += [k1, k2]
+			split_tables += [table, [self.endomorphism(entry) for entry in table]]
+
+		return EllipticCurveFF.multi_mult(self, split_points, split_nums, split_tables, window)
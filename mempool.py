@@ -0,0 +1,489 @@
+from transaction import transaction_size
+
+from time import time
+from heapq import heappush, heappop, heapify
+from collections import deque
+
+# limits on how much the mempool holds
+MAX_MEMPOOL_ENTRIES = 50000
+MAX_MEMPOOL_BYTES = 10*2**20
+
+# seconds a transaction can wait before it is dropped
+MEMPOOL_EXPIRY = 24*60*60
+
+# after an eviction, transactions must pay at least the evicted fee rate plus this
+# the minimum then halves every MIN_FEE_HALF_LIFE seconds
+MIN_FEE_RATE_INCREMENT = 1/1000
+MIN_FEE_HALF_LIFE = 10*60
+
+# once a template is within BLOCK_FULL_MARGIN bytes of full,
+# stop looking after MAX_PACKING_MISSES transactions in a row don't fit
+BLOCK_FULL_MARGIN = 1000
+MAX_PACKING_MISSES = 1000
+
+# miner fee per byte
+def fee_rate(t, size=None):
+	if size is None:
+		size = transaction_size(t)
+	return t.miner_fee/max(size, 1)
+
+# transactions waiting to be mined, ordered by fee rate
+#
+# the order is kept in heaps that are never popped from
+# removing a transaction only deletes it from lookup, which makes its heap entries stale
+# the heaps are rebuilt once there are more stale entries than live ones
+#
+# when it is full the lowest fee rate transactions are evicted
+# and the minimum fee rate goes up so they can't just be sent again
+class Mempool:
+
+	def __init__(self, max_entries=MAX_MEMPOOL_ENTRIES, max_bytes=MAX_MEMPOOL_BYTES, expiry=MEMPOOL_EXPIRY):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.expiry = expiry
+
+		# hash -> (transaction, arrival time, sequence number, size)
+		self.lookup = {}
+		self.total_size = 0
+
+		# sender address -> set of hashes
+		self.by_sender = {}
+
+		# address -> total amount sent to it by transactions here (not counting sending to yourself)
+		self.incoming = {}
+
+		# (-fee rate, sequence number, hash) for mining highest fee rates first
+		# the sequence number breaks ties by arrival and tells live entries from stale ones
+		self._heap = []
+
+		# (fee rate, -sequence number, hash) for evicting lowest fee rates first (newest first on ties)
+		self._eviction_heap = []
+
+		# (arrival time, sequence number, hash) oldest first, for expiring transactions
+		# (iterating lookup from the front gets slow once the oldest entries are deleted)
+		self._arrivals = deque()
+
+		self._next_seq = 0
+
+		# fee rate floor from the last eviction and when it was set
+		self._min_fee_rate = 0
+		self._min_fee_time = 0
+
+	def __len__(self):
+		return len(self.lookup)
+
+	def __contains__(self, t_hash):
+		return t_hash in self.lookup
+
+	def get(self, t_hash):
+		if t_hash in self.lookup:
+			return self.lookup[t_hash][0]
+		return None
+
+	# transactions paying less than this per byte are not accepted
+	def min_fee_rate(self, now=None):
+		if self._min_fee_rate == 0:
+			return 0
+
+		if now is None:
+			now = time()
+		rate = self._min_fee_rate * 0.5**((now - self._min_fee_time)/MIN_FEE_HALF_LIFE)
+
+		# stop tracking it once it is too small to matter
+		if rate < MIN_FEE_RATE_INCREMENT/2:
+			self._min_fee_rate = 0
+			return 0
+		return rate
+
+	# returns True if the transaction was added
+	# it is not added if it is already here, pays less than min_fee_rate, or would be evicted right away
+	def add(self, t):
+		if t.hash in self.lookup:
+			return False
+
+		now = time()
+		self.expire(now)
+
+		size = transaction_size(t)
+		rate = fee_rate(t, size)
+		if rate < self.min_fee_rate(now):
+			return False
+
+		seq = self._next_seq
+		self._next_seq += 1
+
+		self.lookup[t.hash] = (t, now, seq, size)
+		self.total_size += size
+		self.by_sender.setdefault(t.from_addr, set()).add(t.hash)
+		if t.to_addr != t.from_addr and t.amount > 0:
+			self.incoming[t.to_addr] = self.incoming.get(t.to_addr, 0) + t.amount
+
+		self._compact_if_needed()
+		heappush(self._heap, (-rate, seq, t.hash))
+		heappush(self._eviction_heap, (rate, -seq, t.hash))
+		self._arrivals.append((now, seq, t.hash))
+
+		self._evict(now)
+		return t.hash in self.lookup
+
+	# returns the removed transaction or None
+	def remove(self, t_hash):
+		if t_hash not in self.lookup:
+			return None
+
+		t, arrival, seq, size = self.lookup.pop(t_hash)
+		self.total_size -= size
+
+		hashes = self.by_sender[t.from_addr]
+		hashes.discard(t_hash)
+		if len(hashes) == 0:
+			del self.by_sender[t.from_addr]
+
+		if t.to_addr != t.from_addr and t.amount > 0:
+			self.incoming[t.to_addr] -= t.amount
+			if self.incoming[t.to_addr] == 0:
+				del self.incoming[t.to_addr]
+
+		self._compact_if_needed()
+		return t
+
+	# transactions sent by [addr]
+	def from_sender(self, addr):
+		return [self.lookup[i][0] for i in self.by_sender.get(addr, ())]
+
+	# removes transactions that arrived more than [expiry] seconds ago
+	# returns the number removed
+	def expire(self, now=None):
+		if now is None:
+			now = time()
+
+		removed = 0
+		while len(self._arrivals) > 0:
+			arrival, seq, t_hash = self._arrivals[0]
+			if self._is_live(t_hash, seq):
+				if arrival > now - self.expiry:
+					break
+				self.remove(t_hash)
+				removed += 1
+			self._arrivals.popleft()
+		return removed
+
+	# removes the lowest fee rate transactions until the mempool fits in its limits
+	def _evict(self, now):
+		while len(self.lookup) > self.max_entries or self.total_size > self.max_bytes:
+			rate, neg_seq, t_hash = heappop(self._eviction_heap)
+			if not self._is_live(t_hash, -neg_seq):
+				continue
+
+			self.remove(t_hash)
+			self._min_fee_rate = max(self.min_fee_rate(now), rate + MIN_FEE_RATE_INCREMENT)
+			self._min_fee_time = now
+
+	def _is_live(self, t_hash, seq):
+		res = self.lookup.get(t_hash)
+		return res is not None and res[2] == seq
+
+	def _compact_if_needed(self):
+		if len(self._heap) + len(self._eviction_heap) + len(self._arrivals) > 6*len(self.lookup) + 128:
+			self.compact()
+
+	# drop the stale heap entries
+	def compact(self):
+		self._heap = [i for i in self._heap if self._is_live(i[2], i[1])]
+		heapify(self._heap)
+		self._eviction_heap = [i for i in self._eviction_heap if self._is_live(i[2], -i[1])]
+		heapify(self._eviction_heap)
+		self._arrivals = deque(i for i in self._arrivals if self._is_live(i[2], i[1]))
+
+	# yields transactions from highest to lowest fee rate without changing the heap
+	# a heap entry is always before its children, so this only looks at about 2k entries to yield k transactions
+	# transactions can be removed while iterating (compacting makes a new heap, so this one is left alone), but don't add any
+	def gen_decreasing(self):
+		self._compact_if_needed()
+
+		heap = self._heap
+		if len(heap) == 0:
+			return
+
+		frontier = [(heap[0], 0)]
+		while len(frontier) > 0:
+			entry, i = heappop(frontier)
+
+			if self._is_live(entry[2], entry[1]):
+				yield self.lookup[entry[2]][0]
+
+			for child in (2*i + 1, 2*i + 2):
+				if child < len(heap):
+					heappush(frontier, (heap[child], child))
+
+
+# the best transactions to put in the next block
+# kept up to date as transactions arrive and blocks are added, instead of being rebuilt from the ledger each time
+#
+# balances has how much each sender in the mempool has at the tip of the blockchain
+# transactions are only checked against these balances here, so check everything else before adding them
+#
+# transactions are picked by fee rate until the block is full
+# a transaction whose sender doesn't have enough money waits until a picked transaction sends them some,
+# so the order of the template matters (see is_valid_multiple in transaction.Ledger)
+class BlockTemplate:
+
+	def __init__(self, mempool, max_size):
+		self.mempool = mempool
+		self.max_size = max_size
+
+		# hash of the block the balances are for
+		self.tip = None
+		self.balances = {}
+
+		self.transactions = []
+		self.size = 0
+		self._hashes = set()
+		self._available = {}
+		self._worst_fee_rate = None
+		self.dirty = True
+
+		# (-fee rate, sequence number, hash) of transactions left out of the template, best first
+		# the space mined transactions leave is filled from here before walking the mempool again
+		self._passed = []
+		self._smallest_passed = None
+		# False if the last walk stopped before the end of the mempool
+		self._walked_all = False
+
+	# adds a transaction to the mempool
+	# [balance] is how much the sender has at self.tip (None if they don't have any)
+	# returns False if the mempool didn't take it
+	def add(self, t, balance):
+		if not self.mempool.add(t):
+			return False
+
+		self.balances[t.from_addr] = balance
+		if self.dirty:
+			return True
+
+		cost = t.amount + t.miner_fee
+		size = self.mempool.lookup[t.hash][3]
+		rate = fee_rate(t, size)
+
+		# money sent to someone with transactions waiting could let them be picked
+		if t.to_addr in self.mempool.by_sender and t.to_addr != t.from_addr:
+			self.dirty = True
+		elif self.size + size <= self.max_size and self._get_available(t.from_addr) >= cost:
+			self._append(t, cost, size, rate)
+		elif self._worst_fee_rate is None or rate > self._worst_fee_rate:
+			self.dirty = True
+		else:
+			self._pass(t.hash)
+
+		return True
+
+	def remove(self, t_hash):
+		t = self.mempool.remove(t_hash)
+		if t_hash in self._hashes:
+			self.dirty = True
+		return t
+
+	def contains(self, t_hash):
+		return t_hash in self._hashes
+
+	# [balances] is addr -> money at [tip] (None if they don't have any)
+	# only addresses with transactions in the mempool are kept
+	def set_balances(self, tip, balances):
+		if self._set_balances(tip, balances):
+			self.dirty = True
+
+	# moves the template from self.tip to [tip]
+	# [mined] has the hashes of the transactions in the new blocks and [balances] is like set_balances for every address they changed
+	# the rest of the template is kept as long as it can still be afforded, and the space mined transactions leave is filled again
+	def update(self, tip, mined, balances):
+		touched = set(balances)
+		dropped = set()
+		for t_hash in mined:
+			if t_hash in self._hashes and t_hash in self.mempool:
+				t, arrival, seq, size = self.mempool.lookup[t_hash]
+				dropped.add(t_hash)
+				touched.update((t.from_addr, t.to_addr))
+				self.size -= size
+			self.mempool.remove(t_hash)
+		self._set_balances(tip, balances)
+
+		if self.dirty:
+			return
+
+		if len(dropped) > 0:
+			self.transactions = [i for i in self.transactions if i.hash not in dropped]
+			self._hashes -= dropped
+
+		# replay the template for the touched addresses, everyone else has the same money left as before
+		available = {i: self.balances.get(i) or 0 for i in touched}
+		for t in self.transactions:
+			if t.from_addr in available:
+				available[t.from_addr] -= t.amount + t.miner_fee
+				if available[t.from_addr] < 0:
+					self.dirty = True
+					return
+			if t.to_addr in available:
+				available[t.to_addr] += t.amount
+		self._available.update(available)
+
+		self._refill()
+
+		# a touched sender that can now pay for something better than the template has
+		for addr in touched:
+			for t_hash in self.mempool.by_sender.get(addr, ()):
+				t, arrival, seq, size = self.mempool.lookup[t_hash]
+				if t_hash in self._hashes or t.amount + t.miner_fee > self._available[addr]:
+					continue
+				if self._worst_fee_rate is None or fee_rate(t, size) > self._worst_fee_rate:
+					self.dirty = True
+					return
+
+	# returns True if a sender in the mempool got a new balance
+	def _set_balances(self, tip, balances):
+		self.tip = tip
+		changed = False
+		for addr, money in balances.items():
+			if addr in self.mempool.by_sender:
+				self.balances[addr] = money
+				changed = True
+			else:
+				self.balances.pop(addr, None)
+		return changed
+
+	# drop balances of senders that don't have transactions in the mempool anymore
+	def prune(self):
+		for addr in [i for i in self.balances if i not in self.mempool.by_sender]:
+			del self.balances[addr]
+
+	# returns the transactions in the template in the order they have to be in the block
+	def get(self):
+		# transactions in the template could have been evicted or expired from the mempool
+		if self.dirty or any(i not in self.mempool for i in self._hashes):
+			self._rebuild()
+		return list(self.transactions)
+
+	# money [addr] has left after the transactions in the template
+	def _get_available(self, addr):
+		if addr not in self._available:
+			self._available[addr] = self.balances.get(addr) or 0
+		return self._available[addr]
+
+	def _append(self, t, cost, size, rate):
+		self._available[t.from_addr] = self._get_available(t.from_addr) - cost
+		self._available[t.to_addr] = self._get_available(t.to_addr) + t.amount
+
+		self.transactions.append(t)
+		self._hashes.add(t.hash)
+		self.size += size
+		if self._worst_fee_rate is None or rate < self._worst_fee_rate:
+			self._worst_fee_rate = rate
+
+	# walks the mempool by fee rate and takes everything affordable that fits
+	def _rebuild(self):
+		self.transactions = []
+		self.size = 0
+		self._hashes = set()
+		self._available = {}
+		self._worst_fee_rate = None
+		self._passed = []
+		self._smallest_passed = None
+		self._fill()
+		self.dirty = False
+
+	# adds the best transactions not in the template yet until it is full
+	def _fill(self):
+		# sender -> transactions that need more money than the sender has so far, best first
+		waiting = {}
+		misses = 0
+
+		self._walked_all = False
+		for t in self.mempool.gen_decreasing():
+			if self.max_size - self.size < BLOCK_FULL_MARGIN and misses >= MAX_PACKING_MISSES:
+				break
+			if t.hash in self._hashes:
+				continue
+
+			# can't be mined unless the sender gets more money
+			if t.amount + t.miner_fee > (self.balances.get(t.from_addr) or 0) + self.mempool.incoming.get(t.from_addr, 0):
+				self.mempool.remove(t.hash)
+				continue
+
+			if self._pick(t, waiting):
+				misses = 0
+			else:
+				misses += 1
+			if t.hash not in self._hashes:
+				self._pass(t.hash)
+		else:
+			self._walked_all = True
+
+	# fills the template from the transactions passed over since the last walk
+	# only walks the mempool again if those run out before the template is full
+	def _refill(self):
+		waiting = {}
+		passed = []
+		misses = 0
+		while len(self._passed) > 0:
+			if self.max_size - self.size < BLOCK_FULL_MARGIN and misses >= MAX_PACKING_MISSES:
+				break
+			# none of them fit anymore
+			if self.max_size - self.size < self._smallest_passed:
+				break
+
+			entry = heappop(self._passed)
+			if entry[2] in self._hashes or not self.mempool._is_live(entry[2], entry[1]):
+				continue
+
+			if self._pick(self.mempool.lookup[entry[2]][0], waiting):
+				misses = 0
+			else:
+				misses += 1
+			if entry[2] not in self._hashes:
+				passed.append(entry)
+
+		for entry in passed:
+			heappush(self._passed, entry)
+
+		# there could be more that fit below where the last walk stopped
+		if self.max_size - self.size >= BLOCK_FULL_MARGIN and not self._walked_all:
+			self._fill()
+
+	# remembers that [t_hash] was left out of the template
+	def _pass(self, t_hash):
+		t, arrival, seq, size = self.mempool.lookup[t_hash]
+		heappush(self._passed, (-fee_rate(t, size), seq, t_hash))
+		if self._smallest_passed is None or size < self._smallest_passed:
+			self._smallest_passed = size
+
+		# drop the ones that left the mempool or were picked
+		if len(self._passed) > 2*len(self.mempool) + 128:
+			self._passed = [i for i in self._passed if i[2] not in self._hashes and self.mempool._is_live(i[2], i[1])]
+			heapify(self._passed)
+
+	# adds [t] to the template if it can, along with any waiting transactions it pays for
+	# returns False if [t] didn't fit
+	def _pick(self, t, waiting):
+		if self.size + self.mempool.lookup[t.hash][3] > self.max_size:
+			return False
+
+		stack = [t]
+		while len(stack) > 0:
+			t = stack.pop()
+			cost = t.amount + t.miner_fee
+			size = self.mempool.lookup[t.hash][3]
+
+			# a waiting transaction that doesn't fit anymore
+			if self.size + size > self.max_size:
+				continue
+
+			if self._get_available(t.from_addr) < cost:
+				waiting.setdefault(t.from_addr, []).append(t)
+				continue
+
+			self._append(t, cost, size, fee_rate(t, size))
+
+			# try the transactions this one sent money for again, best first
+			if t.to_addr in waiting and t.to_addr != t.from_addr:
+				stack.extend(reversed(waiting.pop(t.to_addr)))
+
+		return True
@@ -17,6 +17,11 @@ REQUESTING - GET
 /ping
 /ping/miner
 
+/stats/mining
+
+# for remote mining workers (see worker.py)
+/mining/work    [count=<number of nonces>]
+
 
 SENDING - POST
 
@@ -25,6 +30,8 @@ SENDING - POST
 
 # for miners
 /transaction/new    data=<transaction>
+/transaction/batch    data=<transactions separated by newlines>    (returns a result for each on its own line)
+/mining/submit    job=<job id> nonce=<nonce>
 
 """
 
@@ -43,8 +50,13 @@ SERVER_ADDR = "http://192.168.5.36:8000"
 PORT = 8000
 
 # number of mining subprocesses
+# "python benchmark.py mining" shows how well the hashrate scales with more processes
 NUM_MINING_PROCESSES = 10
 
+# number of subprocesses for checking the signatures in new blocks
+# 0 checks them in the main process
+NUM_VERIFICATION_PROCESSES = 4
+
 # pre-existing nodes for getting connected to the network
 # at least one known node is needed to connect to an existing blockchain
 KNOWN_NODES = ["http://192.168.4.42:8000"]
@@ -59,7 +71,7 @@ if __name__=="__main__":
 		MINER_ADDR = w.get_addr("miner")
 
 	# create the miner and start mining
-	m1 = MinerNode(MINER_ADDR, NUM_MINING_PROCESSES, SERVER_ADDR, port=PORT)
+	m1 = MinerNode(MINER_ADDR, NUM_MINING_PROCESSES, SERVER_ADDR, port=PORT, verification_processes=NUM_VERIFICATION_PROCESSES)
 	m1.start()
 	m1.get_up_to_date(KNOWN_NODES)
 
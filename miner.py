@@ -1,42 +1,98 @@
 from utils import *
 from transaction import Transaction
-from blockchain import Block
+from blockchain import Block, block_data_hash, MAX_BLOCK_SIZE
 from node import SavableActiveNode
+from signature import VerificationPool
+from mempool import Mempool, BlockTemplate, fee_rate
 
-from threading import Thread, Lock
-from time import time
-from heapq import heapify, heappop
+from threading import Thread, Lock, Event
+from queue import Empty
+from time import time, sleep
+from hashlib import sha256
 
 from multiprocessing import Process, Value, Array, Queue
 from ctypes import c_wchar_p
-
-MAX_TRANSACTIONS_IN_BLOCK = 20
-
-# not very efficient but works
-# need to rethink if you suddenly have thousands of transactions
-class TransactionPriorityStructure:
-
-	def __init__(self):
-		self.lookup = {}
-
-	def add(self, t):
-		if t.hash not in self.lookup:
-			self.lookup[t.hash] = (t, time())
-
-	def remove(self, t_hash):
-		if t_hash in self.lookup:
-			del self.lookup[t_hash]
-
-	def gen_decreasing(self):
-		ts = [(-self.lookup[i][0].miner_fee, self.lookup[i][1], i) for i in self.lookup.keys()]
-		heapify(ts)
-
-		while len(ts) > 0:
-			yield self.lookup[heappop(ts)[2]][0]
-
+from json import dumps
+
+# most transactions accepted in one /transaction/batch request
+MAX_TRANSACTIONS_PER_BATCH = 10000
+
+# old jobs are kept so late solutions can still be used if they build on the current block
+MAX_RECENT_JOBS = 8
+
+# each mining process searches its own range of nonces
+# process i starts at i*NONCES_PER_PROCESS
+NONCES_PER_PROCESS = 2**64
+
+# remote workers (see worker.py) get nonces starting at REMOTE_NONCE_START
+# so they never overlap with the local processes
+REMOTE_NONCE_START = 2**128
+REMOTE_NONCES_PER_REQUEST = 10**6
+MAX_REMOTE_NONCES_PER_REQUEST = 10**9
+
+# mining kernel
+# tries the nonces start, start+1, ..., start+count-1 on top of data_hash
+# returns the first one whose block hash meets the target, or None
+def search_nonces(data_hash, target_bytes, start, count):
+	# the hash of data_hash + nonce only needs data_hash to be hashed once
+	copy = sha256(data_hash.encode()).copy
+	for n in range(start, start + count):
+		h = copy()
+		h.update(b"%d" % n)
+		if h.digest() <= target_bytes:
+			return n
+	return None
+
+# counters for each mining process kept in shared memory
+# each process only writes to its own slot, and stale is only written by the main process
+class MiningStats:
+	def __init__(self, num_processes):
+		self.num_processes = num_processes
+		self.hashes = Array("Q", num_processes, lock=False)
+		self.solutions = Array("Q", num_processes, lock=False)
+		self.stale = Array("Q", num_processes, lock=False)
+		self.last_refresh = Array("d", num_processes, lock=False)
+		self.reset_time()
+
+	# call when mining starts
+	def reset_time(self):
+		self.start_time = time()
+
+		# time and hashes from the last call to report
+		self._last_sample = (self.start_time, list(self.hashes))
+
+	# hashrate is measured since the last report
+	# average_hashrate is measured since start_time
+	def report(self):
+		now = time()
+		hashes = list(self.hashes)
+		last_time, last_hashes = self._last_sample
+		self._last_sample = (now, hashes)
+
+		processes = []
+		for i in range(self.num_processes):
+			processes.append({
+				"hashes": hashes[i],
+				"hashrate": (hashes[i] - last_hashes[i])/max(now - last_time, 1e-9),
+				"average_hashrate": hashes[i]/max(now - self.start_time, 1e-9),
+				"solutions": self.solutions[i],
+				"stale_solutions": self.stale[i],
+				"last_work_refresh": self.last_refresh[i],
+			})
+
+		return {
+			"processes": processes,
+			"hashes": sum(p["hashes"] for p in processes),
+			"hashrate": sum(p["hashrate"] for p in processes),
+			"average_hashrate": sum(p["average_hashrate"] for p in processes),
+			"solutions": sum(p["solutions"] for p in processes),
+			"stale_solutions": sum(p["stale_solutions"] for p in processes),
+			"uptime": now - self.start_time,
+		}
 
 # locking order is alphabetical:
 # 		blockchain_lock
+#		jobs_lock
 #		sources_lock
 #		transactions_lock
 # (try to not have multiple locks at once though)
@@ -44,37 +100,59 @@ class TransactionPriorityStructure:
 # a node that also mines new blocks and recieves transactions
 # to mine into the blockchain
 class MinerNode(SavableActiveNode):
-	def __init__(self, miner_addr, num_processes, *args, **kwargs):
+	# verification_processes is the number of processes for checking signatures in new blocks (0 to check them in this process)
+	def __init__(self, miner_addr, num_processes, *args, verification_processes=0, **kwargs):
 		super().__init__(*args, **kwargs)
 
 		self.miner_addr = miner_addr
+		self.verification_processes = verification_processes
 		self.known_miners.append(self.web_addr)
 
-		self.available_transactions = TransactionPriorityStructure()
+		self.available_transactions = Mempool()
+		self.template = BlockTemplate(self.available_transactions, MAX_BLOCK_SIZE)
 		self.transaction_lock = Lock()
 
 		self.background_threads.append(Thread(target=self.mining_update_background))
 		self.background_threads.append(Thread(target=self.new_block_handler_background))
 
+		# data hash and proof of work target that the mining processes are working on
+		# job_id goes up every time they change so the processes can check for new work cheaply
 		self.data_hash = Array("c", 44)
-		self.block_data = ([], "", "")
+		self.target = Array("c", 32)
+		self.job_id = Value("Q", 0, lock=False)
+
+		# job id -> (transactions, miner, prev_block_hash, timestamp, target bytes, data hash) for recent jobs
+		self.jobs = {}
+		self.jobs_lock = Lock()
+
+		# job id -> next nonce to give to a remote worker
+		self.remote_nonces = {}
+
+		# set when the work should be recalculated right away
+		self.work_update_event = Event()
 
 		self.new_block_queue = Queue()
 		self.mining = Value("b", False)
+		self.mining_stats = MiningStats(num_processes)
 
 		self.mining_processes = [
 			Process(
 				target=MinerNode.mining_process,
-				args=(self.data_hash, self.mining, self.new_block_queue, self.miner_addr)
+				args=(self.data_hash, self.target, self.job_id, self.mining, self.new_block_queue, self.miner_addr, i, self.mining_stats)
 			) for i in range(num_processes)
 		]
 
 	def start(self):
+		# start the pool before any threads are running
+		if self.verification_processes > 0:
+			self.verification_pool = VerificationPool(self.ledger.sig_algorithm, self.verification_processes)
+
 		SavableActiveNode.start(self)
 
 		with self.mining.get_lock():
 			self.mining.value = True
 
+		self.mining_stats.reset_time()
 		for i in self.mining_processes:
 			i.start()
 
@@ -87,18 +165,31 @@ class MinerNode(SavableActiveNode):
 		for i in self.mining_processes:
 			i.join()
 
+		if self.verification_pool is not None:
+			self.verification_pool.close()
+			self.verification_pool = None
+
 	def add_block(self, block, **kwargs):
+		prev_tip = self.get_prev_block_hash()
+
 		SavableActiveNode.add_block(self, block, **kwargs)
 
-		if self.get_prev_block_hash() == block.hash:
-			with self.transaction_lock:
-				for t in block.transactions:
-					self.available_transactions.remove(t.hash)
+		# mine on top of the new block right away
+		if self.get_prev_block_hash() != prev_tip:
+			self.work_update_event.set()
 
 
 	def handle_get(self, path, query, wfile):
 		if path == ["ping", "miner"]:
 			wfile.write("TRUE".encode())
+		elif path == ["stats", "mining"]:
+			wfile.write(dumps(self.mining_stats.report()).encode())
+		elif path == ["mining", "work"]:
+			try:
+				work = self.get_work(int(query.get("count", REMOTE_NONCES_PER_REQUEST)))
+				wfile.write((dumps(work) if work is not None else "NO WORK").encode())
+			except:
+				wfile.write("INVALID REQUEST".encode())
 		else:
 			SavableActiveNode.handle_get(self, path, query, wfile)
 
@@ -109,77 +200,219 @@ class MinerNode(SavableActiveNode):
 				wfile.write("BLOCK RECIEVED".encode())
 			except:
 				wfile.write("INVALID REQUEST".encode())
+		elif path == ["transaction", "batch"]:
+			try:
+				transaction_strs = [i for i in query["data"].split("\n") if i != ""]
+				if len(transaction_strs) > MAX_TRANSACTIONS_PER_BATCH:
+					raise Exception("Too many transactions")
+				wfile.write("\n".join(self.on_new_transactions(transaction_strs)).encode())
+			except:
+				wfile.write("INVALID REQUEST".encode())
+		elif path == ["mining", "submit"]:
+			try:
+				wfile.write(self.submit_solution(int(query["job"]), query["nonce"]).encode())
+			except:
+				wfile.write("INVALID REQUEST".encode())
 		else:
 			SavableActiveNode.handle_post(self, path, query, wfile)
 
-	def _block_data_hash(self, prev_block_hash, transactions, miner):
-		transactions_hash = hash_base64(" ".join(t.hash for t in transactions))
-		return hash_base64(prev_block_hash + transactions_hash + self.miner_addr)
-
 	def on_new_transaction(self, transaction_str):
 		try:
-			transaction = Transaction.convert_from_str(transaction_str)
-
-			with self.blockchain_lock:
-				valid = self.ledger.is_valid(transaction)
-
-			if valid:
-				with self.transaction_lock:
-					self.available_transactions.add(transaction)
-
+			self.on_new_transactions([transaction_str])
 		except:
 			return
 
-	def get_verified_transactions(self, num):
-		res = []
+	# checks many new transactions together and adds the valid ones to the mempool
+	# returns a result for each one: "ACCEPTED", "DUPLICATE", "LOW FEE", "INVALID", or "BAD SIGNATURE"
+	def on_new_transactions(self, transaction_strs):
+		results = [None]*len(transaction_strs)
+		ts = [None]*len(transaction_strs)
+		for i, transaction_str in enumerate(transaction_strs):
+			try:
+				ts[i] = Transaction.convert_from_str(transaction_str)
+			except:
+				results[i] = "INVALID"
 
+		# cheap checks first so the signature check can be skipped for transactions that would be turned away
+		# money sent by earlier transactions in the batch can be spent, like money sent by the mempool
+		seen = set()
+		batch_incoming = {}
 		with self.blockchain_lock:
 			with self.transaction_lock:
-				# close to the is_valid_multiple method of transaction.Ledger
-				spending = {}
-				transaction_hashes = set()
-
-				for t in self.available_transactions.gen_decreasing():
-
-					if not self.ledger.is_valid(t):
-						self.available_transactions.remove(t.hash)
+				min_fee_rate = self.available_transactions.min_fee_rate()
+				for i, t in enumerate(ts):
+					if t is None:
 						continue
 
-					if t.from_addr not in spending:
-						spending[t.from_addr] = 0
+					if t.hash in self.available_transactions or t.hash in seen:
+						results[i] = "DUPLICATE"
+					elif fee_rate(t) < min_fee_rate:
+						results[i] = "LOW FEE"
+					elif not self._is_valid_for_mempool(t, batch_incoming.get(t.from_addr, 0))[0]:
+						results[i] = "INVALID"
+					else:
+						seen.add(t.hash)
+						if t.to_addr != t.from_addr:
+							batch_incoming[t.to_addr] = batch_incoming.get(t.to_addr, 0) + t.amount
+
+		# signatures don't depend on the ledger so they are checked without any locks
+		# a bad signature only rejects its own transaction
+		unchecked = [i for i in range(len(ts)) if results[i] is None]
+		try:
+			sigs = self.ledger._check_sigs([ts[i] for i in unchecked], self.verification_pool)
+		except:
+			# the pool failed, so check them here
+			sigs = self.ledger._check_sigs([ts[i] for i in unchecked])
 
-					if spending[t.from_addr] + t.amount + t.miner_fee > self.ledger.money[t.from_addr]:
-						self.available_transactions.remove(t.hash)
-						continue
+		for i, valid in zip(unchecked, sigs):
+			if not valid:
+				results[i] = "BAD SIGNATURE"
 
-					if t.hash in transaction_hashes:
-						self.available_transactions.remove(t.hash)
+		changed = False
+		with self.blockchain_lock:
+			with self.transaction_lock:
+				for i in unchecked:
+					if results[i] is not None:
 						continue
 
-					spending[t.from_addr] += t.amount + t.miner_fee
-					transaction_hashes.add(t.hash)
+					t = ts[i]
+					valid, balance = self._is_valid_for_mempool(t)
+					if t.hash in self.available_transactions:
+						results[i] = "DUPLICATE"
+					elif not valid:
+						results[i] = "INVALID"
+					elif not self.template.add(t, balance):
+						results[i] = "LOW FEE"
+					else:
+						results[i] = "ACCEPTED"
+						changed = changed or self.template.dirty or self.template.contains(t.hash)
+
+		# update the work right away if the transactions changed the template
+		if changed:
+			self.work_update_event.set()
+
+		return results
+
+	# checks everything but the signature of a new transaction
+	# the sender can also spend money sent to them by transactions in the mempool, and [extra_incoming] more
+	# blockchain_lock and transaction_lock must be held
+	# returns (valid, the sender's balance)
+	def _is_valid_for_mempool(self, t, extra_incoming=0):
+		incoming = self.available_transactions.incoming.get(t.from_addr, 0) + extra_incoming
+		balance = self.ledger.money.get(t.from_addr)
+		if balance is None and incoming == 0:
+			return False, balance
+		return self.ledger._is_valid_without_sig(t, (balance or 0) + incoming), balance
+
+	# called with blockchain_lock held whenever the current block changes
+	# transactions in connected blocks are taken out of the mempool
+	# and transactions in disconnected blocks are put back in if they are still valid
+	def on_chain_update(self, disconnected, connected):
+		tip = self.ledger.current_node.hash
+		prev_tip = disconnected[0].hash if len(disconnected) > 0 else connected[0].prev_node.hash
+
+		# oldest first so transactions come back in an order that can be mined
+		readded = []
+		for node in reversed(disconnected):
+			if node.hash in self.blocks:
+				readded += Block.convert_from_str(self.blocks[node.hash]).transactions
+
+		with self.transaction_lock:
+			# the template doesn't know the balances before this change, so it needs all of them
+			if self.template.tip != prev_tip:
+				self._refresh_template(tip)
+			else:
+				addrs = set()
+				for node in disconnected + connected:
+					addrs.update(node.net_ledger)
+
+				mined = [t_hash for node in connected for t_hash in node.transaction_hashes]
+				self.template.update(tip, mined, {i: self.ledger.money.get(i) for i in addrs})
+
+			# their signatures were already checked when their blocks were added
+			for t in readded:
+				valid, balance = self._is_valid_for_mempool(t)
+				if valid:
+					self.template.add(t, balance)
+
+			self.template.prune()
+
+	# reads every sender's balance from the ledger and takes out anything already in the blockchain
+	# blockchain_lock and transaction_lock must be held
+	def _refresh_template(self, tip):
+		for t_hash in [i for i in self.available_transactions.lookup if i in self.ledger.past_transactions]:
+			self.template.remove(t_hash)
+		self.template.set_balances(tip, {i: self.ledger.money.get(i) for i in self.available_transactions.by_sender})
+
+	# brings the template up to the tip of the blockchain
+	# only needed when it has never been or was loaded from a file, otherwise on_chain_update keeps it up to date
+	def _update_template(self):
+		with self.blockchain_lock:
+			tip = self.get_prev_block_hash(has_lock=True)
+
+			with self.transaction_lock:
+				if tip != self.template.tip:
+					self._refresh_template(tip)
+					self.template.prune()
 
-					res.append(t)
-					if len(res) >= num:
-						break
+	# returns the best transactions to mine and the hash of the block they can go on top of
+	def get_verified_transactions(self):
+		with self.transaction_lock:
+			self.available_transactions.expire()
+			return self.template.get(), self.template.tip
 
-		return res
+	def _calculate_mining_data(self):
+		while True:
+			transactions, template_tip = self.get_verified_transactions()
 
-	def _calculate_mining_data(self, num_transactions=MAX_TRANSACTIONS_IN_BLOCK):
-		transactions = self.get_verified_transactions(num_transactions)
-		prev_hash = self.get_prev_block_hash()
+			with self.blockchain_lock:
+				prev_hash = self.get_prev_block_hash(has_lock=True)
+				target, min_timestamp = self.get_next_block_rules()
 
-		with self.data_hash.get_lock():
-			self.data_hash.value = self._block_data_hash(prev_hash, transactions, self.miner_addr).encode()
+			if template_tip == prev_hash:
+				break
+			self._update_template()
+		timestamp = max(int(time()), min_timestamp)
+
+		data_hash = block_data_hash(prev_hash, transactions, self.miner_addr, timestamp)
+
+		with self.jobs_lock:
+			job_id = self.job_id.value + 1
+			self.jobs[job_id] = (transactions, self.miner_addr, prev_hash, timestamp, target_to_bytes(target), data_hash)
+			while len(self.jobs) > MAX_RECENT_JOBS:
+				old_job_id = next(iter(self.jobs))
+				del self.jobs[old_job_id]
+				self.remote_nonces.pop(old_job_id, None)
+
+			with self.data_hash.get_lock():
+				self.data_hash.value = data_hash.encode()
+				self.target.raw = target_to_bytes(target)
+				self.job_id.value = job_id
+
+	# waits up to [t] seconds for event to be set
+	# returns False if self.running == False
+	def _wait_event(self, event, t):
+		while t > 0:
+			if not self.running:
+				return False
+
+			interval = min(t, 5)
+			t -= interval
+			if event.wait(interval):
+				break
 
-		self.block_data = (transactions, self.miner_addr, prev_hash)
+		return self.running
 
-	def mining_update_background(self, interval=60, num_transactions=MAX_TRANSACTIONS_IN_BLOCK):
+	# recalculates the work every [interval] seconds,
+	# or sooner when work_update_event is set (but at most once every [min_interval] seconds)
+	def mining_update_background(self, interval=60, min_interval=1):
 		while True:
+			self.work_update_event.clear()
+			self._calculate_mining_data()
 
-			self._calculate_mining_data(num_transactions)
-
-			if not self._wait_running(interval):
+			if not self._wait_running(min_interval):
+				break
+			if not self._wait_event(self.work_update_event, interval - min_interval):
 				break
 
 	def _on_passed_block(self, block_str):
@@ -190,44 +423,96 @@ class MinerNode(SavableActiveNode):
 		print()
 		print()
 		print()
-		self._calculate_mining_data()
 
-	def new_block_handler_background(self, interval=1):
-		while True:
-			try:
-				data_hash, nonce = self.new_block_queue.get_nowait()
+	# work for a remote worker: the current job and a range of [count] nonces nobody else is using
+	# returns None if there isn't a job yet
+	def get_work(self, count=REMOTE_NONCES_PER_REQUEST):
+		count = min(max(count, 1), MAX_REMOTE_NONCES_PER_REQUEST)
 
-				transactions, miner, prev_block_hash = self.block_data
+		with self.jobs_lock:
+			job_id = self.job_id.value
+			if job_id not in self.jobs:
+				return None
 
-				if self._block_data_hash(prev_block_hash, transactions, miner) != data_hash:
-					continue
+			start = self.remote_nonces.get(job_id, REMOTE_NONCE_START)
+			self.remote_nonces[job_id] = start + count
+			target, data_hash = self.jobs[job_id][4:]
 
-				block = Block(transactions, miner, prev_block_hash, nonce).convert_to_str()
+		return {"job": job_id, "data_hash": data_hash, "target": target.hex(), "nonce_start": start, "nonce_count": count}
 
-				Thread(target=self._on_passed_block, args=(block,)).start()
-			except:
-				pass
+	# turn a solution to a job into a block
+	# returns "ACCEPTED", "STALE", or "INVALID"
+	def submit_solution(self, job_id, nonce):
+		# nonces go in the block string so only allow digits
+		if not nonce.isdigit():
+			return "INVALID"
 
-			if not self._wait_running(interval):
-				break
+		with self.jobs_lock:
+			job = self.jobs.get(job_id)
 
-	def mining_process(self_data_hash, self_mining, self_new_block_queue, self_miner_addr, hashes_at_a_time=10**5, hashes_before_exit_check=10**5):
+		# solutions to old jobs are still fine if they build on the current block
+		if job is None or job[2] != self.get_prev_block_hash():
+			return "STALE"
 
-		n = 0
-		data_hash = ""
+		transactions, miner, prev_block_hash, timestamp, target, data_hash = job
+		if not proof_of_work_check(hash_digest(data_hash + nonce), target):
+			return "INVALID"
 
-		while True:
-			if n%hashes_at_a_time == 0:
-				data_hash = self_data_hash.value.decode()
-			if n%hashes_before_exit_check == 0:
-				if not self_mining.value:
-					break
+		block = Block(transactions, miner, prev_block_hash, nonce, timestamp).convert_to_str()
+		Thread(target=self._on_passed_block, args=(block,)).start()
+		return "ACCEPTED"
+
+	# waits for solutions from the mining processes
+	# [timeout] is how often it checks if the node stopped
+	def new_block_handler_background(self, timeout=1):
+		while self.running:
+			try:
+				job_id, data_hash, nonce, process_index = self.new_block_queue.get(timeout=timeout)
+			except Empty:
+				continue
+
+			try:
+				if self.submit_solution(job_id, nonce) == "STALE":
+					self.mining_stats.stale[process_index] += 1
+			except:
+				pass
+
+	# self_stats is an optional MiningStats to record counters in
+	# the job id is checked every [hashes_at_a_time] hashes, so new work is picked up within a few milliseconds
+	def mining_process(self_data_hash, self_target, self_job_id, self_mining, self_new_block_queue, self_miner_addr, process_index=0, self_stats=None, hashes_at_a_time=10**4):
 
-			nonce = str(randint(1,2**256))
-			if proof_of_work_verify(hash_base64(data_hash + nonce)):
-				self_new_block_queue.put((data_hash, nonce))
+		job_id = 0
+		data_hash = ""
+		n = 0
 
-			n += 1
+		while self_mining.value:
+			if self_job_id.value != job_id:
+				with self_data_hash.get_lock():
+					job_id = self_job_id.value
+					data_hash = self_data_hash.value.decode()
+					target = self_target.raw
+
+				# start at the beginning of this process's nonces for new work
+				n = process_index*NONCES_PER_PROCESS
+				if self_stats is not None:
+					self_stats.last_refresh[process_index] = time()
+
+			if job_id == 0:
+				sleep(0.1)
+				continue
+
+			nonce = search_nonces(data_hash, target, n, hashes_at_a_time)
+			if nonce is None:
+				done = hashes_at_a_time
+			else:
+				self_new_block_queue.put((job_id, data_hash, str(nonce), process_index))
+				done = nonce + 1 - n
+
+			n += done
+			if self_stats is not None:
+				self_stats.hashes[process_index] += done
+				if nonce is not None:
+					self_stats.solutions[process_index] += 1
 
 	def get_save_info(self):
 		return [self.past_blocks, self.ledger, self.blocks, self.sources, self.known_miners, self.port, self.web_addr, self.miner_addr, self.available_transactions]
@@ -237,5 +522,6 @@ class MinerNode(SavableActiveNode):
 		node = MinerNode(miner_addr, web_addr, port=port)
 
 		(node.past_blocks, node.ledger, node.blocks, node.sources, node.known_miners, node.available_transactions) = (past_blocks, ledger, blocks, sources, known_miners, available_transactions)
+		node.template = BlockTemplate(node.available_transactions, MAX_BLOCK_SIZE)
 
 		return node
\ No newline at end of file
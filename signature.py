@@ -1,8 +1,9 @@
 # signature algorithms
 
 from utils import *
-from elliptic import EllipticCurveFF
+from elliptic import EllipticCurveFF, GLVCurveFF, O
 from abc import ABCMeta, abstractmethod
+from multiprocessing import Pool, cpu_count
 
 # every signature algorithm should have at least these methods
 class DigitalSignature(metaclass=ABCMeta):
@@ -24,37 +25,52 @@ class DigitalSignature(metaclass=ABCMeta):
 		pass
 
 # RSA digital signatures
+# processes is how many processes to use when searching for primes
 class RSA(DigitalSignature):
-	def __init__(self):
+	def __init__(self, processes=None):
 		self.prime_bits = 1024
+		self.processes = processes
 
 	def keygen(self):
-		p = gen_prime(self.prime_bits)
-		q = gen_prime(self.prime_bits)
+		p = gen_prime(self.prime_bits, processes=self.processes)
+		q = gen_prime(self.prime_bits, processes=self.processes)
 
 		N = p*q
 
 		e = 2**16 + 1
 		d = mod_inv(e, (p-1)*(q-1))
 
-		return ((e, N), (d, N))
+		# extra values for signing with the chinese remainder theorem
+		dP = d%(p-1)
+		dQ = d%(q-1)
+		q_inv = mod_inv(q, p)
+
+		return ((e, N), (d, N, p, q, dP, dQ, q_inv))
 
+	# uses two half-size exponentiations if the private key has p and q
 	def sign(self, H, priv):
-		return pow(H, priv[0], priv[1])
+		if len(priv) == 2:
+			return pow(H, priv[0], priv[1])
+
+		d, N, p, q, dP, dQ, q_inv = priv
+		m1 = pow(H, dP, p)
+		m2 = pow(H, dQ, q)
+		h = q_inv*(m1 - m2)%p
+		return m2 + h*q
 
 	def verify(self, H, sig, pub):
 		H_1 = pow(sig, pub[0], pub[1])
 		return H == H_1
 
 # digital signature algorithm
+# processes is how many processes to use when searching for primes
 class DSA(DigitalSignature):
-	def __init__(self):
+	def __init__(self, processes=None):
 		L,N = 1024,160
 
-		self.q = gen_prime(N)
-		self.p = randint(2**(L-N-1), 2**(L-N) - 1)*self.q + 1
-		while not is_prob_prime(self.p):
-			self.p = randint(2**(L-N-1), 2**(L-N) - 1)*self.q + 1
+		# p = k*q + 1 for some k between 2^(L-N-1) and 2^(L-N) - 1
+		self.q = gen_prime(N, processes=processes)
+		self.p = gen_prime_in_range(2**(L-N-1)*self.q + 1, (2**(L-N) - 1)*self.q + 2, modulus=2*self.q, residue=1, processes=processes)
 		self.g = pow(2, (self.p-1)//self.q, self.p)
 
 	def keygen(self):
@@ -73,43 +89,89 @@ class DSA(DigitalSignature):
 		S2_inv = mod_inv(S2, self.q)
 		V1 = H*S2_inv%self.q
 		V2 = S1*S2_inv%self.q
-		return pow(self.g, V1, self.p)*pow(pub, V2, self.p)%self.p%self.q == S1
+		return multi_pow([self.g, pub], [V1, V2], self.p)%self.q == S1
 
 # Elliptic curve digital signature algorithm
 # uses secp256k1 curve (bitcoin curve)
 class ECDSA(DigitalSignature):
-	def __init__(self):
+	# table of multiples of G, shared by every instance in the process
+	_G_table = None
+
+	# glv=True uses the secp256k1 endomorphism to speed up multiplication
+	def __init__(self, glv=False):
+		# (prime) order of generator point
+		self.n = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+
 		# define curve
-		self.curve = EllipticCurveFF(2**256 - 2**32 - 977, 0, 7)
+		if glv:
+			self.curve = GLVCurveFF(
+				2**256 - 2**32 - 977, 0, 7, self.n,
+				0x7AE96A2B657C07106E64479EAC3434E99CF0497512F58995C1396C28719501EE,
+				0x5363AD4CC05C30E0A5261C028812645A122E22EA20816678DF02967C1B23BD72,
+				(
+					(0x3086D221A7D46BCDE86C90E49284EB15, -0xE4437ED6010E88286F547FA90ABFE4C3),
+					(0x114CA50F7A8E2F3F657C1108D9D44CFD8, 0x3086D221A7D46BCDE86C90E49284EB15)
+				)
+			)
+		else:
+			self.curve = EllipticCurveFF(2**256 - 2**32 - 977, 0, 7)
 
 		# get generator point
 		self.G = self.curve.uncompress(0xF37CCCFDF3B97758AB40C52B9D0E160E0537F9B65B9C51B2B3E502B62DF02F30)
 
-		# (prime) order of generator point
-		self.n = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+	# G * num using the precomputed table (built the first time it is needed)
+	def _mult_G(self, num):
+		if ECDSA._G_table is None:
+			ECDSA._G_table = self.curve.precompute(self.G)
+		return self.curve.mult_fixed(ECDSA._G_table, num)
+
+	# G * num1 + point * num2 in a single pass
+	# point_table is an optional window_table for point
+	def _mult_G_and(self, num1, point, num2, point_table=None):
+		if ECDSA._G_table is None:
+			ECDSA._G_table = self.curve.precompute(self.G)
+		return self.curve.multi_mult([self.G, point], [num1, num2], tables=[ECDSA._G_table.windows[0], point_table])
 
 	def keygen(self, priv=None):
 		if priv is None:
 			priv = randint(0,self.n-1)
-		pub = self.curve.mult(self.G, priv)
+		pub = self._mult_G(priv)
 		return (pub, priv)
 
 	def sign(self, H, priv):
 		k = randint(0,self.n-1)
-		S1 = self.curve.mult(self.G, k).x%self.n
+		S1 = self._mult_G(k).x%self.n
 		S2 = mod_inv(k, self.n)*(H + S1*priv)%self.n
 		return (S1, S2)
 
 	def verify(self, H, sig, pub):
+		return self._verify(H, sig, pub)
+
+	def _verify(self, H, sig, pub, pub_table=None):
 		S1, S2 = sig
+		if not (0 < S1 < self.n and 0 < S2 < self.n):
+			return False
+
 		S2_inv = mod_inv(S2, self.n)
-		V = self.curve.mult(self.G, H*S2_inv%self.n)
-		V = self.curve.add(V, self.curve.mult(pub, S1*S2_inv%self.n))
+		V = self._mult_G_and(H*S2_inv%self.n, pub, S1*S2_inv%self.n, point_table=pub_table)
+
+		# a signature can be chosen so that V is the point at infinity
+		if V == O:
+			return False
 		return V.x%self.n == S1
 
 # compressed version of ECDSA
 # use base64 strings instead of numbers
 class CompressedECDSA(ECDSA):
+	# uncompressed public keys, shared by every instance in the process
+	# uncompressing needs a modular square root, so this helps a lot when the same keys are used many times
+	PUB_CACHE_SIZE = 10000
+	_pub_cache = LRUCache(PUB_CACHE_SIZE)
+
+	# window tables for keys that have been used more than once (each one is a few KB)
+	PUB_TABLE_CACHE_SIZE = 1000
+	_pub_table_cache = LRUCache(PUB_TABLE_CACHE_SIZE)
+
 	# S1 and S2 take no more than 256 bits
 	def _compress_sig(self, S1, S2):
 		sig = (S1<<256) + S2
@@ -131,7 +193,70 @@ class CompressedECDSA(ECDSA):
 		S1, S2 = super().sign(H, priv)
 		return self._compress_sig(S1, S2)
 
+	# returns (point, window table or None)
+	def _load_pub(self, pub):
+		point = CompressedECDSA._pub_cache.get(pub)
+		if point is None:
+			point = self.curve.uncompress(base64_to_int(pub))
+			CompressedECDSA._pub_cache.put(pub, point)
+			return point, None
+
+		# the key has been seen before, so a table is worth making
+		table = CompressedECDSA._pub_table_cache.get(pub)
+		if table is None:
+			table = self.curve.window_table(point)
+			CompressedECDSA._pub_table_cache.put(pub, table)
+		return point, table
+
 	def verify(self, H, sig, pub):
-		pub = self.curve.uncompress(base64_to_int(pub))
+		pub, pub_table = self._load_pub(pub)
 		sig = self._uncompress_sig(sig)
-		return super().verify(H, sig, pub)
\ No newline at end of file
+		return self._verify(H, sig, pub, pub_table=pub_table)
+
+	def cache_stats():
+		return {"keys": CompressedECDSA._pub_cache.stats(), "tables": CompressedECDSA._pub_table_cache.stats()}
+
+
+# verify batches of signatures across multiple processes
+# each worker process gets its own copy of the signature algorithm
+
+_worker_sig_algorithm = None
+
+def _init_verification_worker(sig_algorithm):
+	global _worker_sig_algorithm
+	_worker_sig_algorithm = sig_algorithm
+
+def _verify_in_worker(args):
+	H, sig, pub = args
+	try:
+		return _worker_sig_algorithm.verify(H, sig, pub)
+	except:
+		return False
+
+class VerificationPool:
+	# batches smaller than min_batch are verified in the calling process
+	# since sending them to the workers costs more than it saves
+	def __init__(self, sig_algorithm, processes=None, min_batch=8):
+		self.sig_algorithm = sig_algorithm
+		self.processes = processes if processes is not None else cpu_count()
+		self.min_batch = min_batch
+		self.pool = Pool(self.processes, initializer=_init_verification_worker, initargs=(sig_algorithm,))
+
+	# takes a list of (H, sig, pub)
+	# returns a list of whether each one is valid
+	def verify_batch(self, batch):
+		if len(batch) < self.min_batch:
+			res = []
+			for H, sig, pub in batch:
+				try:
+					res.append(self.sig_algorithm.verify(H, sig, pub))
+				except:
+					res.append(False)
+			return res
+
+		chunksize = max(1, len(batch)//(4*self.processes))
+		return self.pool.map(_verify_in_worker, batch, chunksize)
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
@@ -0,0 +1,92 @@
+# checks that GLVCurveFF gives exactly the same points as EllipticCurveFF
+# Ledger checks signatures with the GLV curve, so any difference would be a consensus bug
+#
+# python test_glv.py   (or pytest test_glv.py)
+
+from elliptic import EllipticCurveFF, O
+from signature import ECDSA
+
+import random
+
+NUM_RANDOM = 50
+
+glv = ECDSA(glv=True)
+glv_curve = glv.curve
+curve = EllipticCurveFF(glv_curve.p, glv_curve.A, glv_curve.B)
+n = glv.n
+G = glv.G
+
+# 0, 1, n-1, n, 2n and a few more around them
+def edge_scalars():
+	return [0, 1, 2, n-1, n, n+1, 2*n, 2*n+1, -1, -n]
+
+# scalars whose GLV halves (k1, k2) have every combination of signs
+def split_sign_scalars():
+	rng = random.Random(1)
+	found = {}
+	while len(found) < 4:
+		k = rng.randint(1, n-1)
+		k1, k2 = glv_curve.decompose(k)
+		found.setdefault((k1 < 0, k2 < 0), k)
+	return list(found.values())
+
+def random_scalars(seed):
+	rng = random.Random(seed)
+	return [rng.randint(1, n-1) for i in range(NUM_RANDOM)] + [rng.randint(1, 2**128) for i in range(NUM_RANDOM//5)]
+
+def all_scalars(seed=0):
+	return edge_scalars() + split_sign_scalars() + random_scalars(seed)
+
+def random_point(seed):
+	return curve.mult(G, random.Random(seed).randint(1, n-1))
+
+def test_decompose():
+	for k in all_scalars():
+		k1, k2 = glv_curve.decompose(k)
+		assert (k1 + k2*glv_curve.lam - k)%n == 0
+		assert abs(k1) < 2**129 and abs(k2) < 2**129
+
+def test_split_signs_covered():
+	signs = set()
+	for k in split_sign_scalars():
+		k1, k2 = glv_curve.decompose(k)
+		signs.add((k1 < 0, k2 < 0))
+	assert len(signs) == 4
+
+def test_mult():
+	for point in [G, random_point(1)]:
+		for k in all_scalars():
+			assert glv_curve.mult(point, k) == curve.mult(point, k), k
+
+def test_multi_mult():
+	P = random_point(2)
+	Q = random_point(3)
+	scalars = all_scalars(4)
+	rng = random.Random(5)
+	for k in scalars:
+		for a, b in [(k, rng.choice(scalars)), (rng.choice(scalars), k), (k, -k), (-k, k)]:
+			expected = curve.multi_mult([G, P, Q], [a, b, a - b])
+			assert glv_curve.multi_mult([G, P, Q], [a, b, a - b]) == expected, (a, b)
+
+			# generic multi_mult should match separate multiplications too
+			separate = O
+			for point, num in [(G, a), (P, b), (Q, a - b)]:
+				term = curve.mult(point, num%n)
+				separate = curve.add(separate, term)
+			assert expected == separate, (a, b)
+
+# the way ECDSA calls it: a fixed-base table for G and a window table for the public key
+def test_multi_mult_with_tables():
+	G_table = glv_curve.precompute(G)
+	P = random_point(6)
+	P_table = glv_curve.window_table(P, jacobian=True)
+	for a, b in zip(all_scalars(7), reversed(all_scalars(8))):
+		expected = curve.multi_mult([G, P], [a, b])
+		assert glv_curve.multi_mult([G, P], [a, b], tables=[G_table.windows[0], P_table]) == expected, (a, b)
+		assert glv_curve.multi_mult([G, P], [a, b], tables=[G_table.windows[0], None]) == expected, (a, b)
+
+if __name__=="__main__":
+	for name, fn in list(globals().items()):
+		if name.startswith("test_") and callable(fn):
+			fn()
+			print(name, "passed")
@@ -4,6 +4,15 @@
 from utils import *
 from signature import CompressedECDSA
 
+# (hash, sig, pub_key) of transactions whose signatures have already been checked
+# shared by every ledger so a transaction seen in the mempool isn't checked again in a block
+SIGNATURE_CACHE_SIZE = 50000
+verified_signatures = LRUCache(SIGNATURE_CACHE_SIZE)
+
+# size of a transaction in bytes as it is stored in a block
+def transaction_size(t):
+	return len(t.convert_to_str().encode())
+
 # class for storing transaction information
 class Transaction:
 	def __init__(self, from_addr, to_addr, amount, miner_fee, unique_id):
@@ -14,7 +23,8 @@ class Transaction:
 
 		self.unique_id = unique_id
 
-		self.hash = hash_base64(self)
+		self.digest = hash_digest(self)
+		self.hash = digest_to_base64(self.digest)
 
 		self.pub_key = None
 		self.sig = None
@@ -42,49 +52,106 @@ class Transaction:
 # also tracks how much currency everyone has
 class Ledger:
 	def __init__(self):
-		self.sig_algorithm = CompressedECDSA()
+		self.sig_algorithm = CompressedECDSA(glv=True)
 		self.past_transactions = set()
 		self.money = {}
 
 	# checks if a transaction is valid in the context of the ledger
 	def is_valid(self, t):
+		if not self._is_valid_without_sig(t):
+			return False
+
+		# sig must be valid
+		return self._check_sig(t)
+
+	# every check in is_valid except the signature
+	# [available] is how much the sender can spend, their balance if it isn't given
+	def _is_valid_without_sig(self, t, available=None):
 		# hash must not be in past_transactions
 		if t.hash in self.past_transactions:
 			return False
 
 		# money must be available
-		if t.from_addr not in self.money:
-			return False
-		elif (t.amount + t.miner_fee) > self.money[t.from_addr] or t.amount < 0 or t.miner_fee < 0:
+		if available is None:
+			if t.from_addr not in self.money:
+				return False
+			available = self.money[t.from_addr]
+
+		if (t.amount + t.miner_fee) > available or t.amount < 0 or t.miner_fee < 0:
 			return False
 
 		# public key must match from_addr
 		if pub_to_addr(t.pub_key) != t.from_addr:
 			return False
 
-		# sig must be valid
-		return self.sig_algorithm.verify(base64_to_int(t.hash), t.sig, t.pub_key)
+		return True
 
-	# check if multiple transactions are valid
-	def is_valid_multiple(self, ts):
-		# can't spend money you don't have, even if you are getting it in the same block
-		spending = {}
+	# arguments for sig_algorithm.verify
+	def _sig_args(self, t):
+		return (digest_to_int(t.digest), t.sig, t.pub_key)
+
+	def _check_sig(self, t):
+		key = (t.hash, t.sig, t.pub_key)
+		if verified_signatures.get(key, False):
+			return True
+
+		# malformed signatures and keys can make verify raise
+		try:
+			valid = self.sig_algorithm.verify(*self._sig_args(t))
+		except:
+			valid = False
+
+		if valid:
+			verified_signatures.put(key, True)
+		return valid
+
+	# check if multiple transactions are valid when done in order
+	# money received from a transaction can be spent by the transactions after it
+	# signatures are checked last, all at once in the pool if one is given
+	def is_valid_multiple(self, ts, pool=None):
+		# balances after the transactions checked so far
+		balances = {}
 		transaction_hashes = set()
 
 		for t in ts:
 
-			if not self.is_valid(t):
+			if t.from_addr in balances:
+				available = balances[t.from_addr]
+			elif t.from_addr in self.money:
+				available = self.money[t.from_addr]
+			else:
 				return False
 
-			if t.from_addr not in spending:
-				spending[t.from_addr] = 0
-			spending[t.from_addr] += t.amount + t.miner_fee
-
-			if spending[t.from_addr] > self.money[t.from_addr]:
+			if not self._is_valid_without_sig(t, available):
 				return False
 
 			if t.hash in transaction_hashes:
 				return False
 			transaction_hashes.add(t.hash)
 
+			balances[t.from_addr] = available - t.amount - t.miner_fee
+			balances[t.to_addr] = balances.get(t.to_addr, self.money.get(t.to_addr, 0)) + t.amount
+
+		if pool is not None:
+			return all(self._check_sigs(ts, pool))
+
+		for t in ts:
+			if not self._check_sig(t):
+				return False
+
 		return True
+
+	# checks the signatures of ts, all at once in the pool if one is given
+	# returns a list of whether each one is valid (a malformed signature is just invalid)
+	def _check_sigs(self, ts, pool=None):
+		if pool is None:
+			return [self._check_sig(t) for t in ts]
+
+		res = [verified_signatures.get((t.hash, t.sig, t.pub_key), False) for t in ts]
+		unchecked = [i for i in range(len(ts)) if not res[i]]
+		results = pool.verify_batch([self._sig_args(ts[i]) for i in unchecked])
+		for i, valid in zip(unchecked, results):
+			if valid:
+				verified_signatures.put((ts[i].hash, ts[i].sig, ts[i].pub_key), True)
+				res[i] = True
+		return res
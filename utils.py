@@ -1,8 +1,12 @@
 # basic tools needed for the project
 
-from random import randint
+from random import randint, Random
+from math import ceil, log
+from multiprocessing import Pool
 from hashlib import sha256
 from base64 import b64encode, b64decode
+from collections import OrderedDict
+from threading import Lock
 
 """
 GCD and modular arithmetic
@@ -16,18 +20,63 @@ def gcd(a, b):
 # g = gcd(a,b)
 # ax + by = g
 def xgcd(a, b):
-	if b==0:
-		return (a, 1, 0)
-
-	q, r = divmod(a, b)
-	g, x_1, y_1 = xgcd(b, r)
-	return (g, y_1, x_1 - q*y_1)
+	x_0, y_0, x_1, y_1 = 1, 0, 0, 1
+	while b != 0:
+		q, r = divmod(a, b)
+		a, b = b, r
+		x_0, x_1 = x_1, x_0 - q*x_1
+		y_0, y_1 = y_1, y_0 - q*y_1
+	return (a, x_0, y_0)
 
 def mod_inv(a, n):
-	g, x, y = xgcd(a, n)
-	if g != 1:
+	# pow does an iterative extended euclidean algorithm in C
+	try:
+		return pow(a, -1, n)
+	except ValueError:
 		raise ValueError("{} and {} are not coprime".format(a, n))
-	return x%n
+
+# inverses of every number in nums with only one call to mod_inv (Montgomery's trick)
+def batch_mod_inv(nums, n):
+	if len(nums) == 0:
+		return []
+
+	# prefix[i] = nums[0]*nums[1]*...*nums[i]
+	prefix = []
+	acc = 1
+	for a in nums:
+		acc = acc*a%n
+		prefix.append(acc)
+
+	inv = mod_inv(acc, n)
+	res = [0]*len(nums)
+	for i in range(len(nums)-1, 0, -1):
+		res[i] = inv*prefix[i-1]%n
+		inv = inv*nums[i]%n
+	res[0] = inv
+	return res
+
+# bases[0]^exps[0] * bases[1]^exps[1] * ... mod n
+# all the exponents share one set of squarings (Strauss's method)
+def multi_pow(bases, exps, n, window=4):
+	tables = []
+	for b in bases:
+		row = [1]
+		for j in range(1, 1 << window):
+			row.append(row[-1]*b%n)
+		tables.append(row)
+
+	mask = (1 << window) - 1
+	shift = (max(e.bit_length() for e in exps) + window - 1)//window*window
+	res = 1%n
+	while shift > 0:
+		shift -= window
+		for i in range(window):
+			res = res*res%n
+		for row, e in zip(tables, exps):
+			j = (e >> shift) & mask
+			if j:
+				res = res*row[j]%n
+	return res
 
 
 """
@@ -60,54 +109,210 @@ def is_mr_witness(a, n):
 
 	return True
 
-def is_prob_prime(n, prob_fail=1e-80):
-	if n < 2:
-		raise ValueError("Cannot perform primality test on integers less than 2")
-
-	if n==2 or n==3 or n==5 or n==7 or n==11:
+# list of primes less than n (sieve of Eratosthenes)
+def primes_below(n):
+	is_prime = bytearray([1])*n
+	is_prime[0:2] = b"\x00\x00"
+	for i in range(2, int(n**0.5) + 1):
+		if is_prime[i]:
+			is_prime[i*i::i] = bytes(len(range(i*i, n, i)))
+	return [i for i in range(n) if is_prime[i]]
+
+# trial division and sieving use these
+SMALL_PRIMES = primes_below(2000)
+
+# Miller-Rabin with these bases is always right for n < DETERMINISTIC_MR_LIMIT
+DETERMINISTIC_MR_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+DETERMINISTIC_MR_LIMIT = 3317044064679887385961981
+
+# rounds of Miller-Rabin when generating primes
+# a random composite passes a round with much lower probability than 1/4,
+# so this is plenty for searching through random candidates
+GEN_PRIME_ROUNDS = 40
+
+# Miller-Rabin without trial division
+def _mr_test(n, rounds, rng=None):
+	if n < DETERMINISTIC_MR_LIMIT:
+		for a in DETERMINISTIC_MR_BASES:
+			if a%n != 0 and is_mr_witness(a, n):
+				return False
 		return True
 
-	if n%2==0 or n%3==0 or n%5==0 or n%7==0 or n%11==0:
-		return False
-
-	current_prob = 1
-	while current_prob > prob_fail:
-		a = randint(1, n-1)
-		if is_mr_witness(a, n):
+	rand = rng.randint if rng is not None else randint
+	for i in range(rounds):
+		if is_mr_witness(rand(2, n-2), n):
 			return False
-		current_prob *= 0.25
 	return True
 
+# rounds can be given instead of prob_fail
+def is_prob_prime(n, prob_fail=1e-80, rounds=None):
+	if n < 2:
+		raise ValueError("Cannot perform primality test on integers less than 2")
 
-def gen_prime(bits):
-	p = randint(2**(bits-1), 2**bits - 1)
-	while not is_prob_prime(p):
-		p = randint(2**(bits-1), 2**bits - 1)
-	return p
+	for p in SMALL_PRIMES:
+		if n == p:
+			return True
+		if n%p == 0:
+			return False
+	if n < SMALL_PRIMES[-1]**2:
+		return True
+
+	if rounds is None:
+		rounds = ceil(log(prob_fail)/log(0.25))
+	return _mr_test(n, rounds)
+
+# look for a probable prime in start, start+step, ..., start+(count-1)*step
+# candidates with small factors are crossed off first so only a few need Miller-Rabin
+# returns None if there aren't any
+def _sieve_search(start, step, count, rounds, rng=None):
+	composite = bytearray(count)
+	for p in SMALL_PRIMES:
+		if step%p == 0:
+			if start%p == 0:
+				return None
+			continue
+
+		# first i with start + i*step = 0 mod p
+		i = -start*pow(step, -1, p)%p
+		composite[i::p] = b"\x01"*len(range(i, count, p))
+
+	for i in range(count):
+		if not composite[i] and _mr_test(start + i*step, rounds, rng):
+			return start + i*step
+	return None
+
+# search one window starting at a random candidate
+def _search_random_window(low, high, modulus, residue, rounds, window, rng):
+	first = low + (residue - low)%modulus
+	num_candidates = (high - 1 - first)//modulus + 1
+	start = first + modulus*rng.randint(0, num_candidates-1)
+	count = min(window, (high - 1 - start)//modulus + 1)
+	return _sieve_search(start, modulus, count, rounds, rng)
+
+def _search_random_window_task(args):
+	low, high, modulus, residue, rounds, window, seed = args
+	return _search_random_window(low, high, modulus, residue, rounds, window, Random(seed))
+
+# random probable prime p with low <= p < high and p%modulus == residue
+# processes > 1 searches in that many processes at once
+def gen_prime_in_range(low, high, modulus=2, residue=1, rounds=GEN_PRIME_ROUNDS, processes=None, window=4096):
+	if low + (residue - low)%modulus >= high:
+		raise ValueError("No candidates between {} and {}".format(low, high))
+
+	# the sieve needs candidates bigger than the small primes
+	if high <= SMALL_PRIMES[-1]**2:
+		while True:
+			p = low + (residue - low)%modulus + modulus*randint(0, (high - 1 - low - (residue - low)%modulus)//modulus)
+			if p >= 2 and is_prob_prime(p):
+				return p
+
+	if processes is None or processes <= 1:
+		rng = Random(randint(0, 2**64))
+		while True:
+			p = _search_random_window(low, high, modulus, residue, rounds, window, rng)
+			if p is not None:
+				return p
+
+	with Pool(processes) as pool:
+		while True:
+			tasks = [(low, high, modulus, residue, rounds, window, randint(0, 2**64)) for i in range(processes)]
+			for p in pool.imap_unordered(_search_random_window_task, tasks):
+				if p is not None:
+					return p
+
+def gen_prime(bits, rounds=GEN_PRIME_ROUNDS, processes=None):
+	return gen_prime_in_range(2**(bits-1), 2**bits, rounds=rounds, processes=processes)
 
 
 """
 Hashing and converting encoding
 """
 
+# hashes are kept as 32 byte digests
+# and only converted to base64 when they are sent or displayed
+
+# bytes are hashed directly, everything else is hashed as a string
 def get_hash(s):
+	if isinstance(s, bytes):
+		return sha256(s)
 	return sha256(str(s).encode())
 
+def hash_digest(s):
+	return get_hash(s).digest()
+
 def hash_int(s):
-	return int(get_hash(s).hexdigest(), 16)
+	return digest_to_int(hash_digest(s))
 
 def hash_base64(s):
-	return b64encode(get_hash(s).digest()).decode()
+	return digest_to_base64(hash_digest(s))
+
+def digest_to_int(digest):
+	return int.from_bytes(digest, "big")
+
+def digest_to_base64(digest):
+	return b64encode(digest).decode()
+
+def base64_to_digest(b64):
+	return b64decode(b64)
 
 def int_to_base64(num, num_bytes):
-	h = hex(num)[2:]
-	if num_bytes*2 - len(h) < 0:
+	try:
+		return b64encode(num.to_bytes(num_bytes, "big")).decode()
+	except OverflowError:
 		raise ValueError("{} needs more than {} bytes".format(num, num_bytes))
-	h = "0"*(num_bytes*2 - len(h)) + h
-	return b64encode(bytes.fromhex(h)).decode()
 
 def base64_to_int(b64):
-	return int(b64decode(b64).hex(), 16)
+	return int.from_bytes(b64decode(b64), "big")
+
+
+"""
+Caching
+"""
+
+# thread safe dictionary that holds at most max_size items
+# the least recently used item is removed when it gets full
+class LRUCache:
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.data = OrderedDict()
+		self.lock = Lock()
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key, default=None):
+		with self.lock:
+			if key in self.data:
+				self.hits += 1
+				self.data.move_to_end(key)
+				return self.data[key]
+			self.misses += 1
+			return default
+
+	def put(self, key, value):
+		with self.lock:
+			self.data[key] = value
+			self.data.move_to_end(key)
+			while len(self.data) > self.max_size:
+				self.data.popitem(last=False)
+				self.evictions += 1
+
+	def remove(self, key):
+		with self.lock:
+			if key in self.data:
+				del self.data[key]
+
+	def clear(self):
+		with self.lock:
+			self.data.clear()
+
+	def __len__(self):
+		return len(self.data)
+
+	def stats(self):
+		with self.lock:
+			return {"size": len(self.data), "max_size": self.max_size, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
 
 
 """
@@ -131,7 +336,27 @@ def calc_total_reward():
 		total += r
 		block += 1
 
-# pass in hash as an int
-# TODO: SECURITY LEVEL SHOULD BE 4
-def proof_of_work_verify(H, security=4):
-	return H[:security] == "B"*security
+# proof of work means the block hash (as a big endian integer) is at most a target
+# a target of MAX_TARGET//d takes about d hashes to meet
+MAX_TARGET = 2**256 - 1
+
+# as hard as the old check of 4 "B"s at the start of the base64 hash (1 in 2^24)
+INITIAL_TARGET = 2**232 - 1
+
+def difficulty_to_target(difficulty):
+	return max(1, MAX_TARGET//difficulty)
+
+def target_to_difficulty(target):
+	return MAX_TARGET/target
+
+def target_to_bytes(target):
+	return target.to_bytes(32, "big")
+
+# fast check for the mining loop
+# big endian bytes compare the same way as the integers they hold
+def proof_of_work_check(digest, target_bytes):
+	return digest <= target_bytes
+
+# pass in hash as base64
+def proof_of_work_verify(H, target=INITIAL_TARGET):
+	return proof_of_work_check(base64_to_digest(H), target_to_bytes(target))
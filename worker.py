@@ -0,0 +1,83 @@
+# standalone mining worker
+# gets work from a miner over HTTP and sends back any solutions it finds
+# so one miner can use the hashing power of many machines
+#
+# python worker.py http://192.168.5.36:8000 --processes 4
+
+from miner import search_nonces, REMOTE_NONCES_PER_REQUEST
+
+from argparse import ArgumentParser
+from json import loads
+from multiprocessing import Process
+from time import sleep
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+# returns the work as a dictionary or None if the miner doesn't have any
+def fetch_work(node_addr, count=REMOTE_NONCES_PER_REQUEST):
+	with urlopen(Request(node_addr + "/mining/work?" + urlencode({"count": count}))) as res:
+		data = res.read().decode()
+
+	if data == "NO WORK" or data == "INVALID REQUEST":
+		return None
+	return loads(data)
+
+# returns "ACCEPTED", "STALE", or "INVALID"
+def submit_solution(node_addr, job_id, nonce):
+	data = urlencode({"job": job_id, "nonce": nonce}).encode()
+	with urlopen(Request(node_addr + "/mining/submit", data=data)) as res:
+		return res.read().decode()
+
+# hash the nonces in [work] in chunks
+# returns the first solution or None
+def do_work(work, chunk=10**5):
+	target = bytes.fromhex(work["target"])
+	start = work["nonce_start"]
+	end = start + work["nonce_count"]
+
+	while start < end:
+		nonce = search_nonces(work["data_hash"], target, start, min(chunk, end - start))
+		if nonce is not None:
+			return nonce
+		start += chunk
+	return None
+
+# keeps asking for work until the process is killed
+# [count] should be about a second of hashing so the work doesn't get stale
+def worker_loop(node_addr, count=REMOTE_NONCES_PER_REQUEST, retry_interval=1, max_jobs=None):
+	jobs_done = 0
+	while max_jobs is None or jobs_done < max_jobs:
+		try:
+			work = fetch_work(node_addr, count)
+		except Exception as e:
+			print("could not get work:", e)
+			work = None
+
+		if work is None:
+			sleep(retry_interval)
+			continue
+
+		nonce = do_work(work)
+		if nonce is not None:
+			try:
+				print("solution for job", work["job"], submit_solution(node_addr, work["job"], str(nonce)))
+			except Exception as e:
+				print("could not submit solution:", e)
+
+		jobs_done += 1
+
+def main(argv=None):
+	parser = ArgumentParser(description="Mine for a miner on another machine")
+	parser.add_argument("node", help="web address of the miner, like http://192.168.5.36:8000")
+	parser.add_argument("--processes", type=int, default=1)
+	parser.add_argument("--count", type=int, default=REMOTE_NONCES_PER_REQUEST, help="nonces to ask for at a time")
+	args = parser.parse_args(argv)
+
+	processes = [Process(target=worker_loop, args=(args.node, args.count)) for i in range(args.processes)]
+	for p in processes:
+		p.start()
+	for p in processes:
+		p.join()
+
+if __name__=="__main__":
+	main()